@@ -0,0 +1,256 @@
+# XML Preprocessor benchmark harness
+# © Gondwana Software 2024+.
+#
+# Generates synthetic watchface sources that stress particular features, runs preprocess.py on each of them (and on
+# example/watchface), and reports the time taken by every phase and peak memory use. Results can be saved as a
+# baseline, and later runs compared against it. Every output is also checked byte for byte against golden.json, so
+# that performance work can't silently change results. Cold-start latency (how long preprocess.py takes to process a
+# tiny source, and to find that its output is up to date with --incremental) is measured and compared too.
+#
+# Usage: python benchmark/bench.py [--scale=N] [--runs=N] [--save-baseline] [--update-golden] [--threshold=PERCENT] [--keep]
+#    --scale=N multiplies the size of the synthetic sources (default 1)
+#    --runs=N runs each case N times and keeps the fastest time for each phase (default 3); cold starts are run 5 times as often
+#    --save-baseline saves results to baseline.json, for comparison with subsequent runs
+#    --update-golden saves the hashes of the outputs to golden.json; only do this if you've checked the outputs!
+#    --threshold=PERCENT is how much slower a phase, or bigger peak memory, must be to be flagged (default 25)
+#    --keep doesn't delete the generated sources and outputs (they're in benchmark/work)
+# Returns 1 if any output doesn't match golden.json, or anything is slower than the baseline; otherwise 0.
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+PREPROCESS = os.path.join(REPO_DIR, 'preprocess.py')
+WORK_DIR = os.path.join(BENCH_DIR, 'work')
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+GOLDEN_FILE = os.path.join(BENCH_DIR, 'golden.json')
+MIN_SECONDS = 0.02  # phases faster than this are too noisy to flag
+COLD_START_SOURCE = '<WatchFace width="450" height="450">\n<Scene>\n<Group x="{225 - 100}"/>\n</Scene>\n</WatchFace>\n'
+
+# Generators for synthetic sources. Each writes files into a directory and returns the name of the main source file.
+# They're deterministic, so a given scale always produces the same sources (and hence outputs).
+
+def gen_repeats(dir, scale):
+    # Nested <Repeat>s, with {expression}s using the loop variables of enclosing <Repeat>s via <Define>s and PARENT.
+    n = 8 * scale
+    with open(os.path.join(dir, 'repeats.xml'), 'w') as file:
+        file.write(f'''<WatchFace width="450" height="450">
+<Define>
+def pos(i, n): return round(225 + 200 * i / n, 2)
+</Define>
+<Scene>
+<Repeat for="a" in="range({n})">
+  <Define>
+A = a
+  </Define>
+  <Group name="a{{a}}" x="{{pos(a, {n})}}" width="100">
+    <Repeat for="b" in="range({n})">
+      <Define>
+B = A * {n} + b
+      </Define>
+      <Part name="b{{B}}" x="{{b * 2}}" width="{{PARENT.width - b}}">
+        <Repeat for="c" in="range({n})">
+          <Rect x="{{c}}" y="{{B + c}}" width="{{PARENT.width}}" height="{{SELF.x}}"/>
+        </Repeat>
+      </Part>
+    </Repeat>
+  </Group>
+</Repeat>
+</Scene>
+</WatchFace>
+''')
+    return 'repeats.xml'
+
+def gen_symbols(dir, scale):
+    # Many <Use>s of deeply nested <Symbol>s, with attributes, <Delete>s and <Transform>s.
+    depth, uses = 6, 200 * scale
+    with open(os.path.join(dir, 'symbols.xml'), 'w') as file:
+        file.write('<WatchFace width="450" height="450">\n')
+        file.write('<Symbol id="s0"><Group name="leaf"><Rect width="2" height="10" fill="#FFFFFF"/><Text t="x"/></Group></Symbol>\n')
+        for level in range(1, depth):
+            file.write(f'<Symbol id="s{level}"><Group name="g{level}" x="{level}"><Use href="#s{level-1}"/>'
+                       f'<Use href="#s{level-1}" y="{level}"/></Group></Symbol>\n')
+        file.write('<Scene>\n')
+        for index in range(uses):
+            if index % 3 == 0:
+                file.write(f'<Use href="#s{depth-1}" name="u{index}" alpha="{index % 256}"/>\n')
+            elif index % 3 == 1:
+                file.write(f'<Use href="#s{depth-1}"><Transform href=".//Rect" target="fill" value="#{index:06X}"/></Use>\n')
+            else:
+                file.write(f'<Use href="#s{depth-1}"><Delete href="Group/Group/Group/Group/Group/Group/Text"/></Use>\n')
+        file.write('</Scene>\n</WatchFace>\n')
+    return 'symbols.xml'
+
+def gen_parent_self(dir, scale):
+    # Deeply nested elements whose attributes use PARENT and SELF a lot.
+    depth, width = 12, 40 * scale
+    with open(os.path.join(dir, 'parent_self.xml'), 'w') as file:
+        file.write('<WatchFace width="450" height="450">\n<Scene>\n')
+        for index in range(width):
+            file.write(f'<Group name="top{index}" x="{index}" y="0" width="450" height="450" data-depth="0">\n')
+            for level in range(1, depth):
+                file.write(f'{" " * level}<Group name="n{level}" x="{{PARENT.x + 1}}" y="{{PARENT.y + SELF.x}}" '
+                           f'width="{{PARENT - 10}}" height="{{PARENT.height - 10}}" data-depth="{{PARENT + 1}}">\n')
+            file.write('<Rect x="{PARENT.x}" y="{PARENT.y}" width="{PARENT.width}" height="{PARENT.height}"/>\n')
+            file.write('</Group>\n' * depth)
+        file.write('</Scene>\n</WatchFace>\n')
+    return 'parent_self.xml'
+
+def gen_imports(dir, scale):
+    # A long chain of <Import>ed .xml files, each of which also <Import>s a .py file.
+    length = 20 * scale
+    for index in range(length):
+        with open(os.path.join(dir, f'part{index}.py'), 'w') as file:
+            file.write(f'PART{index}_X = {index * 3}\n')
+        with open(os.path.join(dir, f'part{index}.xml'), 'w') as file:
+            next = f'<Import href="part{index+1}.xml"/>' if index + 1 < length else ''
+            file.write(f'<Dummy><Import href="part{index}.py"/><Group name="part{index}" x="{{PART{index}_X}}">'
+                       f'<Rect width="{{PARENT.x}}" height="10"/></Group>{next}</Dummy>\n')
+    with open(os.path.join(dir, 'imports.xml'), 'w') as file:
+        file.write('<WatchFace width="450" height="450">\n<Scene>\n<Import href="part0.xml"/>\n</Scene>\n</WatchFace>\n')
+    return 'imports.xml'
+
+def gen_example(dir, scale):
+    # The example watchface, as shipped (scale is ignored).
+    shutil.copytree(os.path.join(REPO_DIR, 'example', 'watchface'), dir, dirs_exist_ok=True)
+    return 'watchface-pp.xml'
+
+CASES = {'repeats': gen_repeats, 'symbols': gen_symbols, 'parent_self': gen_parent_self, 'imports': gen_imports, 'example': gen_example}
+
+def run_case(dir, source):
+    # Runs preprocess.py once. Returns ({phase name: seconds}, peak memory in KiB or None, output bytes).
+    # Peak memory comes from os.wait4(), where available; ru_maxrss is in bytes on macOS and KiB elsewhere.
+    process = subprocess.Popen([sys.executable, PREPROCESS, source, 'out.xml', '-y', '--profile'], cwd=dir,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        returncode = os.waitstatus_to_exitcode(status)
+        peak = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    else:
+        returncode, peak = process.wait(), None
+    if returncode != 0:
+        sys.exit(f"preprocess.py failed on {source} in {dir}:\n{output.decode(errors='replace')}")
+    with open(os.path.join(dir, 'profile-pp.json'), 'r') as file:
+        profile = json.load(file)
+    with open(os.path.join(dir, 'out.xml'), 'rb') as file:
+        result = file.read()
+    return {phase['name']: phase['seconds'] for phase in profile['phases']}, peak, result
+
+def time_cold_starts(runs):
+    # Returns {kind: seconds} for the fastest of several runs of preprocess.py on a tiny source, measured from outside,
+    # so it includes starting Python: 'process' processes it; 'up_to_date' finds (with --incremental) it's up to date.
+    dir = os.path.join(WORK_DIR, 'cold_start')
+    os.makedirs(dir)
+    with open(os.path.join(dir, 'tiny.xml'), 'w') as file: file.write(COLD_START_SOURCE)
+    seconds = {}
+    for kind, args in (('process', ['-y']), ('up_to_date', ['-y', '--incremental'])):
+        if kind == 'up_to_date':    # write the manifest that --incremental checks
+            subprocess.run([sys.executable, PREPROCESS, 'tiny.xml', 'out.xml', '-y', '--incremental'], cwd=dir, stdout=subprocess.DEVNULL)
+        for _ in range(runs):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, PREPROCESS, 'tiny.xml', 'out.xml'] + args, cwd=dir,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            elapsed = time.perf_counter() - start
+            if process.returncode != 0:
+                sys.exit(f"preprocess.py failed on tiny.xml in {dir}:\n{process.stdout.decode(errors='replace')}")
+            seconds[kind] = min(elapsed, seconds.get(kind, elapsed))
+    return seconds
+
+def main():
+    scale, runs, threshold = 1, 3, 25
+    save_baseline = update_golden = keep = False
+    for arg in sys.argv[1:]:
+        if arg.startswith('--scale=') and arg[8:].isdigit(): scale = int(arg[8:])
+        elif arg.startswith('--runs=') and arg[7:].isdigit(): runs = max(1, int(arg[7:]))
+        elif arg.startswith('--threshold=') and arg[12:].isdigit(): threshold = int(arg[12:])
+        elif arg == '--save-baseline': save_baseline = True
+        elif arg == '--update-golden': update_golden = True
+        elif arg == '--keep': keep = True
+        else: sys.exit(f"Unknown argument {arg}; see the top of {__file__} for usage.")
+
+    baseline = golden = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as file: baseline = json.load(file)
+    if os.path.exists(GOLDEN_FILE):
+        with open(GOLDEN_FILE, 'r') as file: golden = json.load(file)
+    if baseline and baseline.get('scale') != scale:
+        print(f"Baseline was saved with --scale={baseline.get('scale')}, so it won't be compared.")
+        baseline = {}
+
+    results = {'scale': scale, 'cases': {}}
+    problems = []
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+    for name, generator in CASES.items():
+        dir = os.path.join(WORK_DIR, name)
+        os.makedirs(dir)
+        source = generator(dir, scale)
+        phases, peak, output = {}, None, None
+        for _ in range(runs):
+            run_phases, run_peak, output = run_case(dir, source)
+            for phase, seconds in run_phases.items(): phases[phase] = min(seconds, phases.get(phase, seconds))
+            if run_peak is not None: peak = run_peak if peak is None else min(peak, run_peak)
+        results['cases'][name] = {'phases': phases, 'total': sum(phases.values()), 'peak_kib': peak}
+
+        # Check output:
+        digest = hashlib.sha256(output).hexdigest()
+        golden_key = name if name == 'example' else f'{name}@{scale}'
+        if update_golden:
+            golden[golden_key] = digest
+        elif golden_key not in golden:
+            print(f"Note: no golden output for {golden_key}; run with --update-golden once you've checked {os.path.join(dir, 'out.xml')}")
+        elif golden[golden_key] != digest:
+            problems.append(f"{name}: output differs from golden (see {os.path.join(dir, 'out.xml')})")
+            keep = True
+
+        # Report and compare with baseline:
+        previous = baseline.get('cases', {}).get(name, {})
+        print(f"\n{name} ({len(output)} bytes output, peak memory {peak if peak is not None else '?'} KiB)")
+        print(f"   {'Phase':<74} {'Seconds':>8} {'Baseline':>8}")
+        for phase, seconds in list(phases.items()) + [('Total', results['cases'][name]['total'])]:
+            before = previous.get('total') if phase == 'Total' else previous.get('phases', {}).get(phase)
+            flag = ''
+            if before is not None and seconds > before * (1 + threshold / 100) and seconds > MIN_SECONDS:
+                flag = ' ⚠️ slower'
+                problems.append(f"{name}: {phase} took {seconds:.3f} s (baseline {before:.3f} s)")
+            print(f"   {phase:<74} {seconds:8.3f} {before if before is not None else float('nan'):8.3f}{flag}")
+        before_peak = previous.get('peak_kib')
+        if peak is not None and before_peak and peak > before_peak * (1 + threshold / 100):
+            problems.append(f"{name}: peak memory {peak} KiB (baseline {before_peak} KiB)")
+
+    # Cold start:
+    cold_start = results['cold_start'] = time_cold_starts(runs * 5)
+    previous = baseline.get('cold_start', {})
+    print(f"\ncold start (tiny source; includes starting Python)")
+    print(f"   {'Run':<74} {'Seconds':>8} {'Baseline':>8}")
+    for kind, label in (('process', 'Processing'), ('up_to_date', 'Finding output up to date (--incremental)')):
+        seconds, before = cold_start[kind], previous.get(kind)
+        flag = ''
+        if before is not None and seconds > before * (1 + threshold / 100) and seconds > MIN_SECONDS:
+            flag = ' ⚠️ slower'
+            problems.append(f"cold start: {label} took {seconds:.3f} s (baseline {before:.3f} s)")
+        print(f"   {label:<74} {seconds:8.3f} {before if before is not None else float('nan'):8.3f}{flag}")
+
+    if save_baseline:
+        with open(BASELINE_FILE, 'w') as file: json.dump(results, file, indent=1)
+        print(f"\nSaved baseline to {BASELINE_FILE}")
+    if update_golden:
+        with open(GOLDEN_FILE, 'w') as file: json.dump(golden, file, indent=1, sort_keys=True)
+        print(f"\nSaved output hashes to {GOLDEN_FILE}")
+    if not keep: shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if problems:
+        print("\n❌ Problems:")
+        for problem in problems: print(f"   {problem}")
+        return 1
+    print("\n✅ No problems found.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,19 +2,41 @@
 # © Gondwana Software 2024+.
 # Returns 0 on success.
 
-xmlpp_DEBUG = False
+import time
+xmlpp_start_seconds = (time.perf_counter(), time.process_time())    # for --timing: when this file started running, and CPU time used before that
 
-class xmlpp_error(Exception):   # custom Exception class
+xmlpp_DEBUG = False
+xmlpp_PHASED = False    # True to walk the tree once per phase, as versions before 2.2.0 did
+xmlpp_INCREMENTAL = False   # True to skip processing if the destination file is up to date
+xmlpp_WATCH = False     # True to reprocess whenever source or an imported file changes
+xmlpp_BATCH = False     # True if xmlpp_source_file is a JSON list of jobs, rather than XML
+xmlpp_JOBS = None       # maximum number of worker processes in batch or parallel mode; None means one per CPU
+xmlpp_PARALLEL = False  # True to evaluate independent subtrees in worker processes
+xmlpp_STRICT = False    # True to refuse Python code that could reach beyond the names it's given (see xmlpp_check_strict())
+xmlpp_OVERWRITE = False
+xmlpp_STREAM = False    # True to write output while processing, rather than after
+xmlpp_LOW_MEMORY = False    # True to keep as little in memory as possible, even if that's slower (implies xmlpp_STREAM)
+xmlpp_PRETTY = None     # string to indent each level of output with (eg, "    "), or None to leave whitespace as it is
+xmlpp_PROFILE = False   # True to report time spent in each phase, {expression} and <Define>
+xmlpp_TIMING = False    # True to report how long starting up (including imports) took, compared with processing
+xmlpp_VERBOSE = True    # False to not print progress to the console (it's still written to the debug file)
+
+class xmlpp_error(Exception):   # custom Exception class; the command line interface calls report() after catching it
     def __init__(self, xmlpp_message, xmlpp_el = None):
+        super().__init__(xmlpp_message)
+        self.message = xmlpp_message
+        self.el = xmlpp_el
+        self.sourceline = None if xmlpp_el is None else xmlpp_el.sourceline
+
+    def report(self):   # print details of the error, and write debug-pp.xml if debugging
+        xmlpp_message, xmlpp_el = self.message, self.el
         print(f"❌ Preprocessor error: {xmlpp_message}")
         if xmlpp_el is not None: print(f"   Reported line number in source file: {xmlpp_el.sourceline}")
-        if xmlpp_DEBUG:
+        if xmlpp_DEBUG and xmlpp_debug_file is not None:    # (it isn't open yet if the error was in the command line)
             xmlpp_debug_file.close()
             print("   Log is in debug-pp.txt")
 
-            try: xmlpp_tree
-            except NameError: pass
-            else:
+            if xmlpp_tree is not None:
                 print("   State of XML at time of error is in debug-pp.xml")
                 if xmlpp_el is not None:
                     xmlpp_el.set("xmlpp-error", xmlpp_message)
@@ -25,43 +47,710 @@ class xmlpp_error(Exception):   # custom Exception class
                     xmlpp_error_tree = xmlpp_ET.parse('debug-pp.xml', xmlpp_parser)
                     xmlpp_error_el = xmlpp_error_tree.xpath('//*[@xmlpp-error][1]')
                     print(f"   Reported line number in debug-pp.xml: {xmlpp_error_el[0].sourceline}")
-        else:
+        elif not xmlpp_DEBUG:
             print("   For more info, run preprocessor with -d argument.")
-        exit(1)
-
-import subprocess
-
-def xmlpp_check_modules():
-    xmlpp_lxml_spec = importlib.util.find_spec('lxml')
-    if xmlpp_lxml_spec is not None: return      # lxml is already installed
-    print("The Python's lxml module is not installed; attempting to install it...")
-    try:
-        subprocess.check_call(['pip', 'install', 'lxml'])
-    except Exception as e:
-        raise xmlpp_error(f"Couldn't install lxml: {type(e).__name__} {sys.exception()}\n   Install lxml manually with 'pip install lxml'.")
 
+import builtins
 import copy
+import hashlib
 import importlib.util
+import io
+import json
+import marshal
+import math
 import os
 import re
 import sys
-xmlpp_check_modules()
-from lxml import etree as xmlpp_ET
-from xml.sax.saxutils import unescape
+import types
+# Modules that are only needed for some options (eg, subprocess, multiprocessing, tempfile) are imported where they're
+# used, rather than here, so that starting up is quicker. lxml is imported by xmlpp_import_lxml() when it's first needed.
+xmlpp_ET = None     # lxml.etree
+xmlpp_lxml_seconds = 0  # time taken to import lxml (for --timing)
+
+def xmlpp_import_lxml():
+    # Imports lxml.etree as xmlpp_ET, if that hasn't been done already.
+    global xmlpp_ET, xmlpp_lxml_seconds
+    if xmlpp_ET is not None: return
+    xmlpp_start = time.perf_counter()
+    try:
+        from lxml import etree as xmlpp_ET
+        xmlpp_lxml_seconds = time.perf_counter() - xmlpp_start
+    except ImportError:
+        raise xmlpp_error("Python's lxml module isn't installed.\n   Install it by running 'python preprocess.py --install-deps' (or 'pip install lxml').")
+
+def xmlpp_install_deps():   # --install-deps
+    # Installs lxml (using pip) if it isn't installed already.
+    if importlib.util.find_spec('lxml') is not None:
+        print("Python's lxml module is already installed.")
+        return
+    print("Python's lxml module is not installed; attempting to install it...")
+    import subprocess
+    try:
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'lxml'])
+    except Exception as e:
+        raise xmlpp_error(f"Couldn't install lxml: {type(e).__name__} {sys.exception()}\n   Install lxml manually with 'pip install lxml'.")
 
-xmlpp_VERSION = "XML Preprocessor 2.1.0"
+xmlpp_VERSION = "XML Preprocessor 2.2.0"
 xmlpp_debug_file = None
 xmlpp_source_file = xmlpp_dest_file = None
+xmlpp_tree = xmlpp_root = None
+xmlpp_namespace = None      # globals for <Define> code and {expression}s: a fresh copy of the preprocessor's globals for every run
 xmlpp_symbols = {}  # associative array (disctionary) of <Symbol> elements, indexed by [id]
+xmlpp_symbol_expansion = {}     # True if xmlpp_symbols[id]'s nested <Use>s have been replaced; False while they're being replaced; indexed by [id]
+xmlpp_dependencies = {}     # hash of every file read while loading source, indexed by [path]
+xmlpp_variables = {}        # predefined symbols for <Define> code and {expression}s (set per job in batch mode)
+xmlpp_parse_cache = {}      # (file state, tree) of every imported .xml file parsed by this process, indexed by [path]
 
 class xmlpp_PhasePrinter:
     def __init__(self): self.phase = 1
     def print(self, text):
-        print(f"\nPhase {self.phase}: {text}...", file=xmlpp_debug_file)
+        if xmlpp_VERBOSE or xmlpp_DEBUG: print(f"\nPhase {self.phase}: {text}...", file=xmlpp_debug_file)
+        if xmlpp_profiler is not None: xmlpp_profiler.start_phase(text.rstrip('.'))
         self.phase += 1
 
 xmlpp_phase_printer = xmlpp_PhasePrinter()
 
+xmlpp_EXPRESSION_REGEXP = re.compile(r'(\{.*?\})')     # TODO 3.9 doesn't work if {} has \n
+xmlpp_PARENT_ATTRIB_REGEXP = re.compile(r'(PARENT\.[a-zA-Z-]+)')
+xmlpp_PARENT_REGEXP = re.compile(r'(PARENT)')
+xmlpp_SELF_ATTRIB_REGEXP = re.compile(r'(SELF\.[a-zA-Z-]+)')
+xmlpp_NUMBER_REGEXP = re.compile(r'(?:0|[1-9][0-9]*)(?:\.[0-9]+)?')   # attribute values that can be passed to templates as numbers
+
+XMLPP_STRICT_BUILTINS = ('abs', 'all', 'any', 'bool', 'chr', 'dict', 'divmod', 'enumerate', 'filter', 'float',
+    'frozenset', 'hex', 'int', 'isinstance', 'len', 'list', 'map', 'max', 'min', 'oct', 'ord', 'pow', 'print', 'range',
+    'repr', 'reversed', 'round', 'set', 'slice', 'sorted', 'str', 'sum', 'tuple', 'zip', 'ArithmeticError', 'Exception',
+    'IndexError', 'KeyError', 'TypeError', 'ValueError', 'ZeroDivisionError', '__build_class__')
+XMLPP_STRICT_ATTRIBUTES = ('format', 'format_map', 'mro', 'gi_frame', 'gi_code', 'cr_frame', 'cr_code', 'ag_frame',
+    'ag_code', 'f_back', 'f_builtins', 'f_globals', 'f_locals', 'tb_frame', 'tb_next',   # ways to reach other objects' internals
+    'getroottree', 'write', 'write_c14n', 'parse', 'parser', 'iterparse', 'xinclude', 'xslt', 'relaxng', 'xmlschema')  # lxml file access (eg, pp_emit("x").getroottree().write(path))
+
+def xmlpp_check_strict(xmlpp_source, xmlpp_mode):
+    # With --strict, raises ValueError if Python code xmlpp_source (compiled with xmlpp_mode, as for compile()) imports
+    # anything, or uses a name or attribute that could reach beyond the strict namespace (see xmlpp_strict_namespace()):
+    # eg, __import__, __class__, str.format() (whose format strings can access attributes) or lxml's getroottree().write().
+    if not xmlpp_STRICT: return
+    import ast
+    try:
+        xmlpp_tree = ast.parse(xmlpp_source.lstrip(' \t') if xmlpp_mode == 'eval' else xmlpp_source, mode=xmlpp_mode)
+    except SyntaxError:
+        return  # compile() will report it, with the right filename and line
+    for xmlpp_node in ast.walk(xmlpp_tree):
+        if isinstance(xmlpp_node, (ast.Import, ast.ImportFrom)):
+            raise ValueError("import isn't allowed with --strict")
+        if isinstance(xmlpp_node, ast.Name) and (xmlpp_node.id.startswith('__') or xmlpp_node.id.startswith('xmlpp') and not xmlpp_node.id.startswith('xmlpp_arg')):
+            raise ValueError(f"'{xmlpp_node.id}' isn't allowed with --strict")
+        if isinstance(xmlpp_node, ast.Attribute) and (xmlpp_node.attr.startswith('_') or xmlpp_node.attr in XMLPP_STRICT_ATTRIBUTES):
+            raise ValueError(f"'.{xmlpp_node.attr}' isn't allowed with --strict")
+
+def xmlpp_strict_namespace():
+    # Returns globals for <Define> code and {expression}s with --strict: only harmless built-in functions, math, and
+    # the preprocessor's pp_ functions, rather than everything in the preprocessor (which includes os, sys, etc).
+    return {'__builtins__': {xmlpp_name: getattr(builtins, xmlpp_name) for xmlpp_name in XMLPP_STRICT_BUILTINS},
+            '__name__': 'xmlpp_strict', 'math': math, 'pp_log': pp_log, 'pp_emit': pp_emit}
+
+class xmlpp_ExpressionCache:
+    """ Remembers work that doesn't depend on the element being processed, so identical strings (common after
+        <Repeat> and <Use> expansion) are only split and compiled once:
+        - template string -> segments (literal text in even entries, (expression, uses PARENT/SELF) in odd entries)
+        - expression source -> compiled code object
+        - expression source with PARENT/SELF terms -> parameterised version (see parameterise()).
+        PARENT and SELF terms are otherwise substituted per element, before the resulting source is looked up; as
+        their values vary, that would mean compiling a new source for nearly every element. """
+    def __init__(self):
+        self.templates = {}
+        self.codes = {}
+        self.strict_codes = {}  # codes checked by xmlpp_check_strict()
+        self.parameterised = {}
+        self.template_hits = self.template_misses = 0
+        self.code_hits = self.code_misses = 0
+
+    def split(self, xmlpp_s):
+        # Returns list of segments, or None if xmlpp_s contains no {expression}.
+        xmlpp_segments = self.templates.get(xmlpp_s, False)
+        if xmlpp_segments is not False:
+            self.template_hits += 1
+            return xmlpp_segments
+        self.template_misses += 1
+        xmlpp_segments = xmlpp_EXPRESSION_REGEXP.split(xmlpp_s)
+        if len(xmlpp_segments) <= 1:
+            xmlpp_segments = None   # no {}
+        else:
+            for xmlpp_matchIndex in range(1, len(xmlpp_segments), 2):
+                xmlpp_exp = xmlpp_segments[xmlpp_matchIndex][1:-1]  # [1:-1] strips { }
+                xmlpp_segments[xmlpp_matchIndex] = (xmlpp_exp, 'PARENT' in xmlpp_exp or 'SELF' in xmlpp_exp)
+        self.templates[xmlpp_s] = xmlpp_segments
+        return xmlpp_segments
+
+    def compile(self, xmlpp_exp, xmlpp_keep=True):
+        # Returns code object for xmlpp_exp. Raises the same exceptions as eval() would, or ValueError if --strict refuses it.
+        # If not xmlpp_keep, the code object isn't cached (eg, because xmlpp_exp is unlikely to be seen again).
+        xmlpp_codes = self.strict_codes if xmlpp_STRICT else self.codes
+        xmlpp_code = xmlpp_codes.get(xmlpp_exp)
+        if xmlpp_code is not None:
+            self.code_hits += 1
+            return xmlpp_code
+        self.code_misses += 1
+        xmlpp_check_strict(xmlpp_exp, 'eval')
+        xmlpp_code = compile(xmlpp_exp.lstrip(' \t'), '<string>', 'eval')     # eval() also ignores leading spaces and tabs
+        if xmlpp_keep: xmlpp_codes[xmlpp_exp] = xmlpp_code
+        return xmlpp_code
+
+    def parameterise(self, xmlpp_exp):
+        # Returns (list of literal text and terms, code object) for xmlpp_exp, which contains PARENT/SELF terms, or None.
+        # Terms are ('PARENT', attribute name) for PARENT.name, ('PARENT', None) for PARENT, or ('SELF', attribute name).
+        # The code object is compiled from xmlpp_exp with the nth term replaced by the name xmlpp_argn. When every
+        # term's value is a plain non-negative number, evaluating it with xmlpp_argn set to those numbers gives the same
+        # result as evaluating xmlpp_exp with the values substituted as text, without compiling anything.
+        # None means that mightn't be so (eg, the term is in a string, or next to a letter or '.'); substitute as text.
+        xmlpp_cached = self.parameterised.get((xmlpp_exp, xmlpp_STRICT), False)
+        if xmlpp_cached is not False: return xmlpp_cached
+        xmlpp_pieces = []
+        for xmlpp_index, xmlpp_piece in enumerate(xmlpp_PARENT_ATTRIB_REGEXP.split(xmlpp_exp)):
+            if xmlpp_index % 2: xmlpp_pieces.append(('PARENT', xmlpp_piece.split('.')[1]))
+            else:
+                for xmlpp_index, xmlpp_piece in enumerate(xmlpp_PARENT_REGEXP.split(xmlpp_piece)):
+                    if xmlpp_index % 2: xmlpp_pieces.append(('PARENT', None))
+                    else:
+                        for xmlpp_index, xmlpp_piece in enumerate(xmlpp_SELF_ATTRIB_REGEXP.split(xmlpp_piece)):
+                            xmlpp_pieces.append(('SELF', xmlpp_piece.split('.')[1]) if xmlpp_index % 2 else xmlpp_piece)
+        xmlpp_source, xmlpp_names, xmlpp_result = '', [], None
+        for xmlpp_index, xmlpp_piece in enumerate(xmlpp_pieces):
+            if isinstance(xmlpp_piece, str):
+                xmlpp_source += xmlpp_piece
+                continue
+            # A number must not join up with what's next to it (eg, '.', a letter or another term's value). Terms and
+            # literal text alternate, so empty text other than at the start or end means two terms are next to each other:
+            xmlpp_before, xmlpp_after = xmlpp_pieces[xmlpp_index - 1], xmlpp_pieces[xmlpp_index + 1]
+            if (xmlpp_before == '' and xmlpp_index > 1) or (xmlpp_after == '' and xmlpp_index + 2 < len(xmlpp_pieces)) or \
+               re.search(r'[\w.]$', xmlpp_before) or re.match(r'[\w.]', xmlpp_after):
+                break
+            xmlpp_names.append(f"xmlpp_arg{len(xmlpp_names)}")
+            xmlpp_source += xmlpp_names[-1]
+        else:
+            import tokenize
+            try:
+                # Each name must be a name in the code, rather than (say) part of a string:
+                xmlpp_tokens = [xmlpp_token.string for xmlpp_token in tokenize.generate_tokens(io.StringIO(xmlpp_source.lstrip(' \t')).readline)
+                                if xmlpp_token.type == tokenize.NAME and xmlpp_token.string.startswith('xmlpp_arg')]
+                if xmlpp_tokens == xmlpp_names:
+                    xmlpp_result = ([xmlpp_piece for xmlpp_piece in xmlpp_pieces if xmlpp_piece != ''], self.compile(xmlpp_source))
+            except Exception:   # eg, tokenize or syntax error, which will be reported when it's substituted as text
+                pass
+        self.parameterised[(xmlpp_exp, xmlpp_STRICT)] = xmlpp_result
+        return xmlpp_result
+
+    def print_stats(self):
+        print(f"   Expression cache: templates {self.template_hits} hits, {self.template_misses} misses; "
+              f"compiled expressions {self.code_hits} hits, {self.code_misses} misses", file=xmlpp_debug_file)
+
+xmlpp_expression_cache = xmlpp_ExpressionCache()
+
+class xmlpp_CodeCache:
+    """ Compiled <Define> code, indexed by a hash of its (un-dedented) source, filename and first line number, so the
+        code is only dedented and compiled when it changes. Like Python's __pycache__, code compiled for a source file
+        is saved in its .xmlpp-cache folder (unless sys.dont_write_bytecode is set, eg by PYTHONDONTWRITEBYTECODE)
+        and loaded by later runs. Code is compiled with the name of the file it came from, and its line numbers, so
+        errors and tracebacks refer to the right lines.
+        With --strict, code is only ever compiled from checked source, and kept in memory: a saved code object could
+        have been put there by anyone who could write to the source's folder, and would run unchecked. """
+    def __init__(self):
+        self.codes = {}     # hash -> code object
+        self.strict_codes = {}  # hash -> code object compiled with --strict (never loaded or saved)
+        self.used = set()   # hashes of code used since load()
+        self.loaded = set() # hashes of code read by load()
+        self.path = None    # file that load() read, and save() writes
+        self.changed = False
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(xmlpp_text, xmlpp_filename, xmlpp_line):
+        return hashlib.sha256(f"{xmlpp_filename}\n{xmlpp_line}\n{xmlpp_text}".encode()).hexdigest()
+
+    def get(self, xmlpp_key):
+        # Returns code object, or None if it hasn't been compiled.
+        xmlpp_code = (self.strict_codes if xmlpp_STRICT else self.codes).get(xmlpp_key)
+        if xmlpp_code is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used.add(xmlpp_key)
+        return xmlpp_code
+
+    def compile(self, xmlpp_key, xmlpp_text, xmlpp_filename, xmlpp_line):
+        # Returns code object for xmlpp_text, which starts at xmlpp_line of xmlpp_filename. Raises the same exceptions
+        # as compile(), or ValueError if --strict refuses it. Blank lines are prepended, rather than renumbering
+        # afterwards, because nested functions' code objects have line numbers of their own.
+        xmlpp_check_strict(xmlpp_text, 'exec')
+        xmlpp_code = compile('\n' * (xmlpp_line - 1) + xmlpp_text, xmlpp_filename, 'exec')
+        if xmlpp_STRICT:
+            self.strict_codes[xmlpp_key] = xmlpp_code
+            return xmlpp_code
+        self.codes[xmlpp_key] = xmlpp_code
+        self.used.add(xmlpp_key)
+        self.changed = True
+        return xmlpp_code
+
+    def load(self, xmlpp_source):
+        # Adds code saved by an earlier run that processed xmlpp_source.
+        self.used = set()
+        self.loaded = set()
+        self.changed = False
+        self.path = None
+        if xmlpp_STRICT: return     # see class comment
+        xmlpp_key = hashlib.sha256(os.path.abspath(xmlpp_source).encode()).hexdigest()[:16]
+        self.path = os.path.join(os.path.dirname(xmlpp_source), '.xmlpp-cache', f"code-{xmlpp_key}.marshal")
+        try:
+            with open(self.path, 'rb') as xmlpp_file:
+                if xmlpp_file.read(len(importlib.util.MAGIC_NUMBER)) != importlib.util.MAGIC_NUMBER: return  # other Python version
+                xmlpp_codes = marshal.load(xmlpp_file)
+            self.codes.update(xmlpp_codes)
+            self.loaded = set(xmlpp_codes)
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+
+    def save(self):
+        # Writes the code used since load() to the file it read, if that would change it.
+        if sys.dont_write_bytecode or self.path is None or not (self.changed or self.loaded - self.used): return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            xmlpp_file, xmlpp_temp_path = xmlpp_open_temp(self.path)
+            with xmlpp_file:
+                xmlpp_file.write(importlib.util.MAGIC_NUMBER)
+                marshal.dump({xmlpp_key: self.codes[xmlpp_key] for xmlpp_key in self.used}, xmlpp_file)
+            os.replace(xmlpp_temp_path, self.path)
+        except OSError:
+            pass    # like __pycache__, the cache is just an optimisation
+
+    def print_stats(self):
+        print(f"   <Define> code cache: {self.hits} hits, {self.misses} misses", file=xmlpp_debug_file)
+
+xmlpp_code_cache = xmlpp_CodeCache()
+
+class xmlpp_ResultCache:
+    """ Results of slow {expression}s, so they needn't be evaluated again while nothing they depend on has changed (eg,
+        when --watch reprocesses a file after a change to one <Define>). Results are indexed by a hash of the compiled
+        expression (which includes PARENT/SELF values substituted into it) and of every global name that it reads,
+        directly or via functions that it calls (found from their code objects' co_names). Global values must be
+        simple immutable data (numbers, strings, tuples of them, etc), functions whose inputs are likewise, or pure
+        built-in functions and modules; an {expression} that depends on anything else (eg, a list, which could have
+        been changed, or print(), which has side effects) is always evaluated. Only expressions that took at least
+        XMLPP_MIN_SECONDS to evaluate are cached, because hashing what they depend on takes time too. Like the code
+        cache, results are saved in the source file's .xmlpp-cache folder (unless sys.dont_write_bytecode is set) and
+        loaded by later runs, except with --strict: results are then kept in memory only, so that planted results
+        can't be used. """
+
+    XMLPP_MIN_SECONDS = 0.001
+    XMLPP_PURE_BUILTINS = ('abs', 'all', 'any', 'ascii', 'bin', 'bool', 'chr', 'complex', 'dict', 'divmod',
+        'enumerate', 'filter', 'float', 'format', 'hex', 'int', 'isinstance', 'len', 'list', 'map', 'max', 'min',
+        'oct', 'ord', 'pow', 'range', 'repr', 'reversed', 'round', 'slice', 'sorted', 'str', 'sum', 'tuple', 'zip',
+        'True', 'False', 'None')   # not set() or hash(), because string hashes (and hence set order) vary between runs
+    XMLPP_PURE_MODULES = ('math', 'cmath')
+    XMLPP_VALUE_TYPES = (int, float, complex, str, bytes, bool, type(None))
+    XMLPP_IMPURE_OPS = ('STORE_NAME', 'STORE_GLOBAL', 'DELETE_NAME', 'DELETE_GLOBAL', 'BUILD_SET', 'SET_ADD', 'SET_UPDATE', 'IMPORT_NAME')
+    XMLPP_MISSING = object()
+
+    def __init__(self):
+        self.results = {}   # hash -> result
+        self.strict_results = {}    # hash -> result evaluated with --strict (never loaded or saved)
+        self.slow = set()   # {expression}s (as written, before PARENT/SELF substitution) that are worth caching
+        self.used = set()   # hashes of results used or added since load()
+        self.loaded = set() # hashes of results read by load()
+        self.path = None    # file that load() read, and save() writes
+        self.changed = False
+        self.hits = self.misses = 0
+        self.code_fingerprints = {}     # code object -> fingerprint, or None if it has side effects
+
+    def evaluate(self, xmlpp_exp, xmlpp_code):
+        # Returns eval(xmlpp_code, xmlpp_namespace), where xmlpp_code was compiled from {expression} xmlpp_exp (as
+        # written, before PARENT/SELF substitution), or its result from an earlier evaluation. Raises what eval() does.
+        xmlpp_key = None
+        if xmlpp_exp in self.slow and not xmlpp_DEBUG:
+            xmlpp_key = self.key(xmlpp_code)
+            if xmlpp_key is not None:
+                self.used.add(xmlpp_key)
+                xmlpp_result = (self.strict_results if xmlpp_STRICT else self.results).get(xmlpp_key, self.XMLPP_MISSING)
+                if xmlpp_result is not self.XMLPP_MISSING:
+                    self.hits += 1
+                    return xmlpp_result
+                self.misses += 1
+        xmlpp_start = time.perf_counter()
+        xmlpp_result = eval(xmlpp_code, xmlpp_namespace)
+        if type(xmlpp_result) not in self.XMLPP_VALUE_TYPES or xmlpp_DEBUG: return xmlpp_result
+        if xmlpp_key is None:
+            if xmlpp_exp in self.slow or time.perf_counter() - xmlpp_start < self.XMLPP_MIN_SECONDS: return xmlpp_result
+            self.slow.add(xmlpp_exp)
+            self.changed = True
+            xmlpp_key = self.key(xmlpp_code)     # what it depends on can't have changed, if it can be cached
+            if xmlpp_key is None: return xmlpp_result
+            self.used.add(xmlpp_key)
+        (self.strict_results if xmlpp_STRICT else self.results)[xmlpp_key] = xmlpp_result
+        self.changed = True
+        return xmlpp_result
+
+    def key(self, xmlpp_code):
+        # Returns hash of xmlpp_code and the current values of the globals it depends on, or None if it can't be cached.
+        xmlpp_fingerprint = self.fingerprint(xmlpp_code, set())
+        if xmlpp_fingerprint is None: return None
+        return hashlib.sha256(xmlpp_fingerprint.encode()).hexdigest()
+
+    def fingerprint(self, xmlpp_value, xmlpp_seen):
+        # Returns a string that identifies xmlpp_value, including the globals it reads if it's code or a function,
+        # or None if it isn't something whose results can be cached. xmlpp_seen holds ids of functions being
+        # fingerprinted, so recursive functions don't recurse forever.
+        xmlpp_type = type(xmlpp_value)
+        if xmlpp_type in self.XMLPP_VALUE_TYPES: return repr(xmlpp_value)
+        if xmlpp_type is tuple:
+            xmlpp_items = [self.fingerprint(xmlpp_item, xmlpp_seen) for xmlpp_item in xmlpp_value]
+            return None if None in xmlpp_items else f"({','.join(xmlpp_items)})"
+        if xmlpp_type is types.ModuleType:
+            return f"<module {xmlpp_value.__name__}>" if xmlpp_value.__name__ in self.XMLPP_PURE_MODULES else None
+        if xmlpp_type is types.BuiltinFunctionType:
+            xmlpp_module = getattr(xmlpp_value, '__module__', None)
+            if xmlpp_module in self.XMLPP_PURE_MODULES or (xmlpp_module == 'builtins' and xmlpp_value.__name__ in self.XMLPP_PURE_BUILTINS):
+                return f"<built-in {xmlpp_module}.{xmlpp_value.__name__}>"
+            return None
+        if xmlpp_type is types.CodeType:
+            xmlpp_code_fingerprint = self.code_fingerprint(xmlpp_value)
+            if xmlpp_code_fingerprint is None: return None
+            xmlpp_parts = [xmlpp_code_fingerprint]
+            for xmlpp_name in sorted(self.names(xmlpp_value)):
+                if xmlpp_name in xmlpp_namespace:
+                    xmlpp_part = self.fingerprint(xmlpp_namespace[xmlpp_name], xmlpp_seen)
+                elif hasattr(builtins, xmlpp_name) and xmlpp_name not in self.XMLPP_PURE_BUILTINS:
+                    xmlpp_part = None   # eg, print() or open(); an attribute with the same name is assumed to be similar
+                else:
+                    xmlpp_part = ''     # a pure built-in function, an attribute name or undefined
+                if xmlpp_part is None: return None
+                xmlpp_parts.append(f"{xmlpp_name}={xmlpp_part}")
+            return '\n'.join(xmlpp_parts)
+        if xmlpp_type is types.FunctionType:
+            if xmlpp_value.__globals__ is not xmlpp_namespace: return None     # eg, pp_log()
+            if id(xmlpp_value) in xmlpp_seen: return f"<recursive {xmlpp_value.__qualname__}>"
+            xmlpp_seen.add(id(xmlpp_value))
+            xmlpp_parts = [self.fingerprint(xmlpp_value.__code__, xmlpp_seen), self.fingerprint(xmlpp_value.__defaults__ or (), xmlpp_seen),
+                           self.fingerprint(tuple(sorted((xmlpp_value.__kwdefaults__ or {}).items())), xmlpp_seen)]
+            for xmlpp_cell in xmlpp_value.__closure__ or ():
+                try:
+                    xmlpp_parts.append(self.fingerprint(xmlpp_cell.cell_contents, xmlpp_seen))
+                except ValueError:  # empty cell
+                    xmlpp_parts.append('')
+            xmlpp_seen.discard(id(xmlpp_value))
+            return None if None in xmlpp_parts else f"<function {'|'.join(xmlpp_parts)}>"
+        return None     # eg, list, dict or Element, which could be changed without changing which object it is
+
+    def code_fingerprint(self, xmlpp_code):
+        # Returns a string that identifies what xmlpp_code does (but not the globals it reads), or None if it has side
+        # effects or its results could vary between runs (eg, it sets a global, or makes a set).
+        if xmlpp_code in self.code_fingerprints: return self.code_fingerprints[xmlpp_code]
+        xmlpp_fingerprint = None
+        import dis
+        if not any(xmlpp_instruction.opname in self.XMLPP_IMPURE_OPS for xmlpp_instruction in dis.get_instructions(xmlpp_code)):
+            xmlpp_consts = []
+            for xmlpp_const in xmlpp_code.co_consts:
+                if type(xmlpp_const) is types.CodeType: xmlpp_const = self.code_fingerprint(xmlpp_const)
+                elif type(xmlpp_const) is frozenset: xmlpp_const = None     # iteration order can vary between runs
+                else: xmlpp_const = repr(xmlpp_const)
+                if xmlpp_const is None: break
+                xmlpp_consts.append(xmlpp_const)
+            else:
+                xmlpp_fingerprint = hashlib.sha256(repr((xmlpp_code.co_code, xmlpp_consts, xmlpp_code.co_names,
+                                                         xmlpp_code.co_varnames, xmlpp_code.co_freevars)).encode()).hexdigest()
+        self.code_fingerprints[xmlpp_code] = xmlpp_fingerprint
+        return xmlpp_fingerprint
+
+    def names(self, xmlpp_code):
+        # Returns set of names that xmlpp_code and code nested in it (eg, lambdas and comprehensions) use, other than
+        # their own local variables: globals, built-in functions and attribute names.
+        xmlpp_names = set(xmlpp_code.co_names)
+        for xmlpp_const in xmlpp_code.co_consts:
+            if type(xmlpp_const) is types.CodeType: xmlpp_names |= self.names(xmlpp_const)
+        return xmlpp_names
+
+    def load(self, xmlpp_source):
+        # Adds results and slow {expression}s saved by an earlier run that processed xmlpp_source.
+        self.used = set()
+        self.loaded = set()
+        self.changed = False
+        self.hits = self.misses = 0
+        self.path = None
+        if xmlpp_STRICT: return     # see class comment
+        xmlpp_key = hashlib.sha256(os.path.abspath(xmlpp_source).encode()).hexdigest()[:16]
+        self.path = os.path.join(os.path.dirname(xmlpp_source), '.xmlpp-cache', f"results-{xmlpp_key}.marshal")
+        try:
+            with open(self.path, 'rb') as xmlpp_file:
+                if xmlpp_file.read(len(importlib.util.MAGIC_NUMBER)) != importlib.util.MAGIC_NUMBER: return  # other Python version
+                xmlpp_slow, xmlpp_results = marshal.load(xmlpp_file)
+            self.slow.update(xmlpp_slow)
+            self.results.update(xmlpp_results)
+            self.loaded = set(xmlpp_results)
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+
+    def save(self):
+        # Writes the slow {expression}s, and results used since load(), to the file load() read, if that would change it.
+        # Results that weren't used are forgotten, so the cache doesn't grow forever.
+        if xmlpp_STRICT or self.path is None or not (self.changed or self.loaded - self.used): return
+        self.results = {xmlpp_key: self.results[xmlpp_key] for xmlpp_key in self.used if xmlpp_key in self.results}
+        if sys.dont_write_bytecode: return  # as for the code cache
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            xmlpp_file, xmlpp_temp_path = xmlpp_open_temp(self.path)
+            with xmlpp_file:
+                xmlpp_file.write(importlib.util.MAGIC_NUMBER)
+                marshal.dump((sorted(self.slow), self.results), xmlpp_file)
+            os.replace(xmlpp_temp_path, self.path)
+        except OSError:
+            pass    # the cache is just an optimisation
+
+xmlpp_result_cache = xmlpp_ResultCache()
+
+class xmlpp_Profiler:
+    """ Records where the time goes when processing (--profile):
+        - wall time, number of elements in the tree at the end, and peak memory use by then, of every phase;
+        - total time and number of calls of every {expression} and <Define>, identified by source line and text.
+        Line numbers are those in the file the element came from, which may have been <Import>ed. """
+
+    XMLPP_TOP = 10  # number of {expression}s and <Define>s listed in the console report
+
+    def __init__(self):
+        self.phases = []    # [name, seconds, elements, peak KiB (None if unknown)] for each phase
+        self.phase_start = None
+        self.items = {}     # [seconds, calls], indexed by [(kind, sourceline, text)]
+
+    def start_phase(self, xmlpp_name):
+        self.end_phase()
+        self.phases.append([xmlpp_name, 0.0, 0, None])
+        self.phase_start = time.perf_counter()
+
+    def end_phase(self):
+        if self.phase_start is None: return
+        self.phases[-1][1] = time.perf_counter() - self.phase_start
+        self.phases[-1][2] = 0 if xmlpp_root is None else sum(1 for _ in xmlpp_root.iter())
+        self.phases[-1][3] = self.peak_memory()
+        self.phase_start = None
+
+    @staticmethod
+    def peak_memory():
+        # Returns the most memory (KiB) this process has used so far, or None if that isn't available (eg, on Windows).
+        # ru_maxrss is in bytes on macOS, and KiB elsewhere.
+        try:
+            import resource
+        except ImportError:
+            return None
+        xmlpp_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return xmlpp_peak // 1024 if sys.platform == 'darwin' else xmlpp_peak
+
+    def add(self, xmlpp_kind, xmlpp_el, xmlpp_text, xmlpp_seconds):
+        xmlpp_item = self.items.setdefault((xmlpp_kind, xmlpp_el.sourceline, xmlpp_text), [0.0, 0])
+        xmlpp_item[0] += xmlpp_seconds
+        xmlpp_item[1] += 1
+
+    def report(self, xmlpp_path):
+        # Prints a summary to the console, and writes everything to xmlpp_path as JSON (sorted so it can be diffed).
+        self.end_phase()
+        print(f"\n{'Phase':<70} {'Seconds':>9} {'Elements':>9} {'Peak KiB':>9}")
+        for xmlpp_name, xmlpp_seconds, xmlpp_elements, xmlpp_peak in self.phases:
+            print(f"{xmlpp_name:<70} {xmlpp_seconds:9.3f} {xmlpp_elements:9} {xmlpp_peak if xmlpp_peak is not None else '?':>9}")
+        print(f"{'Total':<70} {sum(xmlpp_phase[1] for xmlpp_phase in self.phases):9.3f}")
+        if xmlpp_result_cache.hits or xmlpp_result_cache.misses:
+            print(f"\nSlow {{expression}}s: {xmlpp_result_cache.hits} results reused, {xmlpp_result_cache.misses} evaluated again")
+        for xmlpp_kind in ("{expression}", "<Define>"):
+            xmlpp_items = sorted(((xmlpp_key, xmlpp_value) for xmlpp_key, xmlpp_value in self.items.items() if xmlpp_key[0] == xmlpp_kind),
+                                 key=lambda xmlpp_item: -xmlpp_item[1][0])
+            if not xmlpp_items: continue
+            print(f"\n{'Slowest ' + xmlpp_kind + 's':<54} {'Line':>6} {'Calls':>9} {'Seconds':>9}")
+            for (xmlpp_kind, xmlpp_line, xmlpp_text), (xmlpp_seconds, xmlpp_calls) in xmlpp_items[:self.XMLPP_TOP]:
+                xmlpp_text = xmlpp_text if len(xmlpp_text) <= 54 else xmlpp_text[:51] + "..."
+                print(f"{xmlpp_text:<54} {xmlpp_line if xmlpp_line else '?':>6} {xmlpp_calls:9} {xmlpp_seconds:9.3f}")
+
+        xmlpp_data = {
+            "version": xmlpp_VERSION,
+            "source": xmlpp_source_file,
+            "phases": [{"name": xmlpp_name, "seconds": xmlpp_seconds, "elements": xmlpp_elements, "peak_kib": xmlpp_peak}
+                       for xmlpp_name, xmlpp_seconds, xmlpp_elements, xmlpp_peak in self.phases],
+            "items": [{"kind": xmlpp_kind, "line": xmlpp_line, "text": xmlpp_text, "calls": xmlpp_calls, "seconds": xmlpp_seconds}
+                      for (xmlpp_kind, xmlpp_line, xmlpp_text), (xmlpp_seconds, xmlpp_calls)
+                      in sorted(self.items.items(), key=lambda xmlpp_item: (xmlpp_item[0][0], xmlpp_item[0][1] or 0, xmlpp_item[0][2]))]
+        }
+        try:
+            with open(xmlpp_path, 'w') as xmlpp_file:
+                json.dump(xmlpp_data, xmlpp_file, indent=1)
+            print(f"\nProfile is in {xmlpp_path}")
+        except OSError as e:
+            print(f"Warning: couldn't write {xmlpp_path}: {e}")
+
+xmlpp_profiler = None   # xmlpp_Profiler while processing with --profile
+
+class xmlpp_InheritedAttribs:
+    """ Index of the nearest ancestor's value for every attribute name, maintained while walking the tree so that
+        PARENT lookups don't need to climb the tree. push() must be called before processing an element's children,
+        and pop() afterwards. Ancestors' attributes are final before their children are processed, so the index only
+        needs to be rebuilt (by invalidate()) if code run by the preprocessor may have changed the tree. """
+    def __init__(self):
+        self.values = {}    # attribute name -> nearest ancestor's value
+        self.frames = []    # (element, [(attribute name, previous value or None)]) for every ancestor, outermost first
+        self.stale = False
+
+    def push(self, xmlpp_el):
+        xmlpp_undo = []
+        for xmlpp_name, xmlpp_value in xmlpp_el.items():
+            xmlpp_undo.append((xmlpp_name, self.values.get(xmlpp_name)))
+            self.values[xmlpp_name] = xmlpp_value
+        self.frames.append((xmlpp_el, xmlpp_undo))
+
+    def pop(self):
+        for xmlpp_name, xmlpp_value in reversed(self.frames.pop()[1]):
+            if xmlpp_value is None: del self.values[xmlpp_name]
+            else: self.values[xmlpp_name] = xmlpp_value
+
+    def invalidate(self):
+        self.stale = True
+
+    def get(self, xmlpp_name):
+        # Returns None if no ancestor has a value for xmlpp_name.
+        if self.stale:
+            xmlpp_els = [xmlpp_frame[0] for xmlpp_frame in self.frames]
+            self.values = {}
+            self.frames = []
+            self.stale = False
+            for xmlpp_el in xmlpp_els: self.push(xmlpp_el)
+        return self.values.get(xmlpp_name)
+
+xmlpp_inherited_attribs = None  # xmlpp_InheritedAttribs while walking the tree in a single pass
+
+class xmlpp_StreamWriter:
+    """ Writes output during the single-pass walk (--stream), so finished elements can be removed from the tree
+        rather than accumulating until the end:
+        - The root and its children (other than <If>, <Define> and <Repeat>) are 'containers'. Their start tags are
+          written when their first child is written, and their end tags when they're finished.
+        - Other children of a container are written, and removed, as soon as the walk has finished with them.
+        Output is identical to that of xmlpp_tree.write(), with or without xmlpp_ET.indent(). It's written to a temporary
+        file, which is only created once the tree has been loaded and found to be streamable (see start()). """
+
+    XMLPP_NO_CONTAINER_TAGS = ('If', 'Define', 'Repeat')  # elements whose children may not end up in the output
+
+    def __init__(self, xmlpp_dest, xmlpp_indent):
+        self.dest = xmlpp_dest  # path of the destination file, next to which the temporary file is made
+        self.file = self.temp_path = self.xf_context = self.xf = None   # set by start()
+        self.indent = xmlpp_indent  # string for each level of indentation, or None to leave whitespace as it is
+        self.stack = []     # [element, start tag context (None if not written yet), tail of previous child (None if written)] for each open container
+        self.closed = set() # containers that have been written but not yet removed from their parent
+        self.streamed = False   # True once the root's end tag has been written
+
+    def can_stream(self, xmlpp_tree):
+        # Returns False if xmlpp_tree has features that would be written differently by xmlpp_tree.write().
+        xmlpp_root = xmlpp_tree.getroot()
+        return (not xmlpp_tree.docinfo.doctype and xmlpp_root.getprevious() is None and xmlpp_root.getnext() is None
+                and self.is_container(xmlpp_root) and not any(xmlpp_el.nsmap for xmlpp_el in (xmlpp_root, *xmlpp_root)))
+
+    def start(self):
+        # Creates the temporary file and starts writing XML to it. Call only if can_stream() returned True.
+        self.file, self.temp_path = xmlpp_open_temp(self.dest)
+        self.xf_context = xmlpp_ET.xmlfile(self.file)
+        self.xf = self.xf_context.__enter__()
+
+    def finish(self):
+        # Finishes writing after processing. Returns the path of the temporary file holding the output, or None if
+        # nothing was streamed (so the tree must be written in the usual way).
+        if self.file is None: return None
+        self.xf_context.__exit__(None, None, None)
+        self.file.close()
+        if self.streamed: return self.temp_path
+        os.remove(self.temp_path)
+        return None
+
+    def abort(self):
+        # Discards the temporary file (if any), after processing failed.
+        if self.file is None: return
+        try:
+            self.xf_context.__exit__(None, None, None)
+        except Exception:   # eg, because the root's end tag hadn't been written
+            pass
+        self.file.close()
+        os.remove(self.temp_path)
+
+    def is_container(self, xmlpp_el):
+        return (isinstance(xmlpp_el.tag, str) and xmlpp_el.tag not in self.XMLPP_NO_CONTAINER_TAGS      # not a processing instruction
+                and (xmlpp_el is xmlpp_root or xmlpp_el.getparent() is xmlpp_root))
+
+    def is_open(self, xmlpp_el):
+        return bool(self.stack) and self.stack[-1][0] is xmlpp_el
+
+    def indented(self, xmlpp_text, xmlpp_level):
+        # Returns whitespace that xmlpp_ET.indent() would put in place of xmlpp_text at xmlpp_level.
+        if self.indent is None or (xmlpp_text and xmlpp_text.strip()): return xmlpp_text
+        return "\n" + self.indent * xmlpp_level
+
+    def attribs(self, xmlpp_el):
+        return {xmlpp_name: xmlpp_value for xmlpp_name, xmlpp_value in xmlpp_el.attrib.items() if not xmlpp_name.startswith("data-")}
+
+    def begin_content(self, xmlpp_depth):
+        # Writes the start tag of container self.stack[xmlpp_depth] (and its ancestors), if not already written.
+        xmlpp_frame = self.stack[xmlpp_depth]
+        if xmlpp_frame[1] is not None: return
+        if xmlpp_depth: self.begin_child(xmlpp_depth - 1)
+        xmlpp_el = xmlpp_frame[0]
+        xmlpp_frame[1] = self.xf.element(xmlpp_el.tag, self.attribs(xmlpp_el))
+        xmlpp_frame[1].__enter__()
+        xmlpp_text = self.indented(xmlpp_el.text, xmlpp_depth + 1)
+        if xmlpp_text: self.xf.write(xmlpp_text)
+
+    def begin_child(self, xmlpp_depth):
+        # Prepares to write a child of container self.stack[xmlpp_depth].
+        self.begin_content(xmlpp_depth)
+        xmlpp_frame = self.stack[xmlpp_depth]
+        if xmlpp_frame[2] is not None:
+            xmlpp_tail = self.indented(xmlpp_frame[2], xmlpp_depth + 1)
+            if xmlpp_tail: self.xf.write(xmlpp_tail)
+            xmlpp_frame[2] = None
+
+    def open(self, xmlpp_el):
+        self.stack.append([xmlpp_el, None, None])
+
+    def flush(self, xmlpp_el, xmlpp_stop_el):
+        # Writes, and removes, all children of xmlpp_el (the innermost open container) before xmlpp_stop_el
+        # (or all children, if it's None).
+        xmlpp_depth = len(self.stack) - 1
+        xmlpp_child_el = next(iter(xmlpp_el), None)
+        while xmlpp_child_el is not None and xmlpp_child_el is not xmlpp_stop_el:
+            xmlpp_next_el = xmlpp_child_el.getnext()
+            if xmlpp_child_el in self.closed:
+                self.closed.discard(xmlpp_child_el)
+            else:
+                self.begin_child(xmlpp_depth)
+                if self.indent is not None and isinstance(xmlpp_child_el.tag, str):
+                    xmlpp_ET.indent(xmlpp_child_el, self.indent, level=xmlpp_depth+1)
+                self.xf.write(xmlpp_child_el, with_tail=False)
+                self.stack[xmlpp_depth][2] = xmlpp_child_el.tail or ''
+            xmlpp_el.remove(xmlpp_child_el)
+            xmlpp_child_el = xmlpp_next_el
+
+    def close(self, xmlpp_el):
+        # Finishes writing container xmlpp_el, all of whose children have been flushed.
+        xmlpp_frame = self.stack.pop()
+        xmlpp_depth = len(self.stack)
+        if xmlpp_frame[1] is None:  # no children were written, so write it as a whole (this also gets <Empty/> right)
+            if xmlpp_depth: self.begin_child(xmlpp_depth - 1)
+            xmlpp_copy_el = xmlpp_ET.Element(xmlpp_el.tag, self.attribs(xmlpp_el))
+            xmlpp_copy_el.text = xmlpp_el.text
+            self.xf.write(xmlpp_copy_el, with_tail=False)
+        else:
+            if xmlpp_frame[2] is not None:
+                xmlpp_tail = self.indented(xmlpp_frame[2], xmlpp_depth)     # last child's tail is dedented
+                if xmlpp_tail: self.xf.write(xmlpp_tail)
+            xmlpp_frame[1].__exit__(None, None, None)
+        if xmlpp_depth:
+            self.stack[xmlpp_depth - 1][2] = xmlpp_el.tail or ''
+            self.closed.add(xmlpp_el)
+        else:
+            self.streamed = True
+
+xmlpp_stream_writer = None  # xmlpp_StreamWriter while processing with --stream
+# <Use>s that are children of the root or its children, which are left for the single-pass walk to replace when it
+# gets to them (with --low-memory and --stream), rather than all being replaced beforehand, so only one copy of their
+# <Symbol>s need be in the tree at once (the walk writes and removes each one when it's finished). None if not deferring.
+xmlpp_deferred_uses = None
+
 def xmlpp_insert(xmlpp_dest, xmlpp_index, xmlpp_source, xmlpp_children_only=False):
     """ Insert source into dest at index. If source.tag=="Dummy" or xmlpp_children_only, insert children only.
         Returns index of element after insertion(s). """
@@ -76,41 +765,126 @@ def xmlpp_insert(xmlpp_dest, xmlpp_index, xmlpp_source, xmlpp_children_only=Fals
     return xmlpp_index
 
 def xmlpp_parse_args():     # parse command-line arguments
-    global xmlpp_debug_file
-
-    xmlpp_OVERWRITE = False
     xmlpp_USAGE_ERROR = False
-    global xmlpp_source_file, xmlpp_dest_file, xmlpp_DEBUG
+    global xmlpp_source_file, xmlpp_dest_file, xmlpp_DEBUG, xmlpp_PHASED, xmlpp_INCREMENTAL, xmlpp_WATCH, xmlpp_OVERWRITE, xmlpp_BATCH, xmlpp_JOBS, xmlpp_PARALLEL, xmlpp_PROFILE, xmlpp_TIMING, xmlpp_STREAM, xmlpp_LOW_MEMORY, xmlpp_PRETTY, xmlpp_STRICT
+    if sys.argv[1:] == ["--install-deps"]:
+        xmlpp_install_deps()
+        exit(0)
     for xmlpp_i, xmlpp_arg in enumerate(sys.argv[1:], start=1):
         if xmlpp_arg == "-d": xmlpp_DEBUG = True
+        elif xmlpp_arg == "--phased": xmlpp_PHASED = True
+        elif xmlpp_arg == "--incremental": xmlpp_INCREMENTAL = True
+        elif xmlpp_arg == "--watch": xmlpp_WATCH = True
+        elif xmlpp_arg == "--profile": xmlpp_PROFILE = True
+        elif xmlpp_arg == "--timing": xmlpp_TIMING = True
+        elif xmlpp_arg == "--stream": xmlpp_STREAM = True
+        elif xmlpp_arg == "--low-memory": xmlpp_LOW_MEMORY = xmlpp_STREAM = True
+        elif xmlpp_arg == "--pretty": xmlpp_PRETTY = "    "
+        elif xmlpp_arg == "--strict": xmlpp_STRICT = True
+        elif xmlpp_arg == "--batch": xmlpp_BATCH = True
+        elif xmlpp_arg == "--parallel": xmlpp_PARALLEL = True
+        elif xmlpp_arg.startswith("--jobs=") and xmlpp_arg[7:].isdigit() and int(xmlpp_arg[7:]) > 0: xmlpp_JOBS = int(xmlpp_arg[7:])
         elif xmlpp_arg == "-y": xmlpp_OVERWRITE = True
         elif xmlpp_arg[0] == '-': xmlpp_USAGE_ERROR = True
         elif xmlpp_source_file is not None: xmlpp_dest_file = xmlpp_arg
         else: xmlpp_source_file = xmlpp_arg
 
-    if xmlpp_source_file is None or xmlpp_dest_file is None or xmlpp_USAGE_ERROR:
+    if xmlpp_BATCH: xmlpp_USAGE_ERROR |= xmlpp_dest_file is not None or xmlpp_DEBUG or xmlpp_WATCH or xmlpp_PROFILE or xmlpp_PARALLEL
+    else: xmlpp_USAGE_ERROR |= xmlpp_dest_file is None or (xmlpp_JOBS is not None and not xmlpp_PARALLEL)
+    if xmlpp_STREAM: xmlpp_USAGE_ERROR |= xmlpp_DEBUG or xmlpp_PHASED or xmlpp_PARALLEL
+    if xmlpp_PARALLEL: xmlpp_USAGE_ERROR |= xmlpp_DEBUG or xmlpp_PHASED
+
+    if xmlpp_source_file is None or xmlpp_USAGE_ERROR:
         print(xmlpp_VERSION)
-        print("Usage: preprocess.py sourceFile destinationFile [-d] [-y]")
+        print("Usage: preprocess.py sourceFile destinationFile [-d] [-y] [--pretty] [--strict] [--incremental] [--watch] [--profile] [--timing] [--stream | --low-memory | --phased | --parallel [--jobs=N]]")
+        print("       preprocess.py --batch jobsFile [--jobs=N] [-y] [--pretty] [--strict] [--incremental] [--timing] [--stream | --low-memory | --phased]")
+        print("       preprocess.py --install-deps")
         print("   -d prints debugging info")
         print("   -y overwrites destinationFile")
+        print("   --pretty indents destinationFile so it's easier to read")
+        print("   --strict only lets Python code use safe built-in functions and math, for sources you don't trust")
+        print("   --incremental does nothing if no file that destinationFile depends on has changed")
+        print("   --watch keeps running, and processes sourceFile again whenever it or a file it imports changes")
+        print("   --profile reports the time taken by each phase, and by the slowest {expression}s and <Define>s")
+        print("   --timing reports how long starting up (including importing modules) took, compared with processing")
+        print("   --stream writes destinationFile while processing, to use less memory (can't be used with -d)")
+        print("   --low-memory is like --stream, but also uses less memory in other ways that can make processing slower")
+        print("   --phased walks the whole tree once per phase (slower; for comparison with previous versions)")
+        print("   --parallel evaluates independent parts of the tree using several processes at once (can't be used with -d)")
+        print("   --batch processes every job listed in jobsFile (JSON), using several processes at once")
+        print("   --jobs=N limits --parallel or --batch to N processes at once (default: one per CPU)")
+        print("   --install-deps installs Python modules that the preprocessor needs (lxml), if they aren't installed already")
         exit(1)
 
-    if xmlpp_DEBUG:
-        xmlpp_debug_file = open('debug-pp.txt', 'w')
-        print(xmlpp_VERSION, file=xmlpp_debug_file)
-
     if not os.path.exists(xmlpp_source_file):
         raise xmlpp_error("can't find "+xmlpp_source_file)
 
-    if os.path.exists(xmlpp_dest_file) and not xmlpp_OVERWRITE:
-        xmlpp_overwrite_input = input("Destination file already exists; overwrite it (y/n)? ")
-        if (xmlpp_overwrite_input != "y"): exit(2)
+def xmlpp_hash_file(xmlpp_path):
+    # Returns hex digest of the file's content, or None if it can't be read.
+    try:
+        with open(xmlpp_path, 'rb') as xmlpp_file:
+            return hashlib.sha256(xmlpp_file.read()).hexdigest()
+    except OSError:
+        return None
+
+def xmlpp_manifest_path(xmlpp_source, xmlpp_dest):
+    # Returns path of the file that records what xmlpp_dest was built from. There's one per source/destination pair.
+    xmlpp_key = hashlib.sha256(f"{os.path.abspath(xmlpp_source)}\n{os.path.abspath(xmlpp_dest)}".encode()).hexdigest()[:16]
+    return os.path.join(os.path.dirname(xmlpp_source), '.xmlpp-cache', f"manifest-{xmlpp_key}.json")
+
+def xmlpp_manifest(xmlpp_dest):
+    # Returns dictionary describing everything that affects the content of xmlpp_dest.
+    return {
+        "version": xmlpp_VERSION,
+        "tool": xmlpp_hash_file(__file__),
+        "options": {"phased": xmlpp_PHASED, "pretty": xmlpp_PRETTY, "strict": xmlpp_STRICT, "variables": xmlpp_variables},
+        "dependencies": xmlpp_dependencies,
+        "dest": os.path.abspath(xmlpp_dest),
+        "dest_hash": xmlpp_hash_file(xmlpp_dest)
+    }
+
+def xmlpp_is_up_to_date(xmlpp_source, xmlpp_dest):
+    # Returns True if xmlpp_dest exists and was built by this version of the preprocessor, with the same options,
+    # from files that haven't changed since. If so, sets xmlpp_dependencies to those files (eg, for --watch), as
+    # loading the source would have.
+    global xmlpp_dependencies
+    try:
+        with open(xmlpp_manifest_path(xmlpp_source, xmlpp_dest), 'r') as xmlpp_file:
+            xmlpp_previous = json.load(xmlpp_file)
+    except (OSError, ValueError):
+        return False
+    xmlpp_current = xmlpp_manifest(xmlpp_dest)
+    for xmlpp_key in ("version", "tool", "options", "dest", "dest_hash"):
+        if xmlpp_previous.get(xmlpp_key) != xmlpp_current[xmlpp_key]: return False
+    if xmlpp_current["dest_hash"] is None: return False
+    for xmlpp_path, xmlpp_hash in xmlpp_previous.get("dependencies", {}).items():
+        if xmlpp_hash_file(xmlpp_path) != xmlpp_hash:
+            if xmlpp_DEBUG: print(f"   {xmlpp_path} has changed", file=xmlpp_debug_file)
+            return False
+    xmlpp_dependencies = dict(xmlpp_previous.get("dependencies", {}))
+    return True
+
+def xmlpp_write_manifest(xmlpp_source, xmlpp_dest):
+    xmlpp_path = xmlpp_manifest_path(xmlpp_source, xmlpp_dest)
+    try:
+        os.makedirs(os.path.dirname(xmlpp_path), exist_ok=True)
+        with open(xmlpp_path, 'w') as xmlpp_file:
+            json.dump(xmlpp_manifest(xmlpp_dest), xmlpp_file, indent=1)
+    except OSError as e:
+        print(f"Warning: couldn't write {xmlpp_path}: {e}")
 
 def xmlpp_load_source(xmlpp_source):
     # Read source and return tree.
-
-    def xmlpp_load_tree(xmlpp_source):
+    # Every file is only read once per run, however many times it's imported: the first <Import> of a file splices in
+    # its tree, and later ones splice in copies of that (which already has its own <Import>s resolved).
+    xmlpp_imported = {}     # elements spliced in by the first <Import> of every .xml file, indexed by [absolute path]
+    xmlpp_imported_py = {}  # content of every imported .py file, indexed by [absolute path]
+    xmlpp_loading = []      # path of every file being loaded, outermost first, to detect <Import> cycles
+    xmlpp_graph = {}        # paths of files imported by every file, in order, indexed by [path] (for debugging)
+
+    def xmlpp_load_tree(xmlpp_source, xmlpp_cache=False):
         # Read source, and recursively splice in <Import> files.
+        # If xmlpp_cache, reuse the tree from an earlier run if the file hasn't changed since.
         # Returns tree.
 
         def xmlpp_process_imports(xmlpp_element, xmlpp_source):
@@ -121,18 +895,35 @@ def xmlpp_load_source(xmlpp_source):
                 if xmlpp_child_el.tag == "Import":
                     xmlpp_href = xmlpp_child_el.get('href')
                     if xmlpp_DEBUG: print(f"      Found <Import href=\"{xmlpp_href}\" />", file=xmlpp_debug_file)
-                    xmlpp_include_path = os.path.join(os.path.dirname(xmlpp_source), xmlpp_href)    # assume href is relative to source
+                    xmlpp_include_path = os.path.normpath(os.path.join(os.path.dirname(xmlpp_source), xmlpp_href))    # assume href is relative to source
                     if not os.path.exists(xmlpp_include_path):
                         raise xmlpp_error(f"Can't find \"{xmlpp_href}\" imported by \"{xmlpp_source}\".", xmlpp_child_el)
+                    xmlpp_include_abspath = os.path.abspath(xmlpp_include_path)
+                    xmlpp_loading_paths = [os.path.abspath(xmlpp_path) for xmlpp_path in xmlpp_loading]
+                    if xmlpp_include_abspath in xmlpp_loading_paths:
+                        xmlpp_cycle = xmlpp_loading[xmlpp_loading_paths.index(xmlpp_include_abspath):] + [xmlpp_include_path]
+                        raise xmlpp_error(f"<Import> cycle: {' imports '.join(xmlpp_cycle)}.", xmlpp_child_el)
+                    xmlpp_graph.setdefault(xmlpp_source, []).append(xmlpp_include_path)
                     xmlpp_element.remove(xmlpp_child_el)    # remove <Import>
                     if xmlpp_href.lower().endswith('.py'):
-                        xmlpp_el = xmlpp_ET.Element('Define')
-                        with open(xmlpp_include_path, 'r') as xmlpp_file:
-                            xmlpp_el.text = f"\n{xmlpp_file.read()}\n"  # \n so as not to interfere with python indentation
+                        if xmlpp_include_abspath not in xmlpp_imported_py:
+                            xmlpp_dependencies[xmlpp_include_abspath] = xmlpp_hash_file(xmlpp_include_path) if xmlpp_INCREMENTAL else None
+                            with open(xmlpp_include_path, 'r') as xmlpp_file:
+                                xmlpp_imported_py[xmlpp_include_abspath] = xmlpp_file.read()
+                        xmlpp_el = xmlpp_ET.Element('Define', {'xmlpp-file': xmlpp_include_path})
+                        xmlpp_el.text = f"\n{xmlpp_imported_py[xmlpp_include_abspath]}\n"  # \n so as not to interfere with python indentation
                         xmlpp_element.insert(xmlpp_index, xmlpp_el)
+                    elif xmlpp_include_abspath in xmlpp_imported:   # assume .xml, imported before
+                        if xmlpp_DEBUG: print(f"      (copying \"{xmlpp_include_path}\" imported earlier)", file=xmlpp_debug_file)
+                        for xmlpp_imported_el in xmlpp_imported[xmlpp_include_abspath]:
+                            xmlpp_element.insert(xmlpp_index, copy.deepcopy(xmlpp_imported_el))
+                            xmlpp_index += 1
+                        continue    # the copies don't contain <Import>s
                     else:   # assume .xml
-                        xmlpp_child_tree = xmlpp_load_tree(xmlpp_include_path)
+                        xmlpp_child_tree = xmlpp_load_tree(xmlpp_include_path, not xmlpp_LOW_MEMORY)  # the cache holds a copy
                         xmlpp_child_root = xmlpp_child_tree.getroot()
+                        # Spliced-in elements aren't changed while loading, so they can be copied by later <Import>s:
+                        xmlpp_imported[xmlpp_include_abspath] = list(xmlpp_child_root) if xmlpp_child_root.tag == "Dummy" else [xmlpp_child_root]
                         xmlpp_insert(xmlpp_element, xmlpp_index, xmlpp_child_root)
                 else:
                     # Recursively process imports in child elements
@@ -140,22 +931,50 @@ def xmlpp_load_source(xmlpp_source):
                 xmlpp_index += 1
 
         if xmlpp_DEBUG: print(f"   Loading \"{xmlpp_source}\"", file=xmlpp_debug_file)
-        try:
-            xmlpp_parser = xmlpp_ET.XMLParser(remove_comments=True)
-            xmlpp_tree = xmlpp_ET.parse(xmlpp_source, xmlpp_parser)
-        except Exception as e:
-            raise xmlpp_error(f"{type(e).__name__} in \"{xmlpp_source}\": {sys.exception()}")
+        xmlpp_dependencies[os.path.abspath(xmlpp_source)] = xmlpp_hash_file(xmlpp_source) if xmlpp_INCREMENTAL else None
+        xmlpp_tree = None
+        if xmlpp_cache:
+            xmlpp_stat = os.stat(xmlpp_source)
+            xmlpp_state = (xmlpp_stat.st_mtime_ns, xmlpp_stat.st_size)
+            xmlpp_cached = xmlpp_parse_cache.get(os.path.abspath(xmlpp_source))
+            if xmlpp_cached is not None and xmlpp_cached[0] == xmlpp_state:
+                if xmlpp_DEBUG: print(f"      (reusing tree parsed earlier)", file=xmlpp_debug_file)
+                xmlpp_tree = copy.deepcopy(xmlpp_cached[1])
+        if xmlpp_tree is None:
+            try:
+                xmlpp_parser = xmlpp_ET.XMLParser(remove_comments=True)
+                xmlpp_tree = xmlpp_ET.parse(xmlpp_source, xmlpp_parser)
+            except Exception as e:
+                raise xmlpp_error(f"{type(e).__name__} in \"{xmlpp_source}\": {sys.exception()}")
+            for xmlpp_define_el in xmlpp_tree.getroot().iter('Define'):     # so <Define> code is compiled with the right filename
+                xmlpp_define_el.set('xmlpp-file', xmlpp_source)
+            if xmlpp_cache: xmlpp_parse_cache[os.path.abspath(xmlpp_source)] = (xmlpp_state, copy.deepcopy(xmlpp_tree))
 
         xmlpp_root = xmlpp_tree.getroot()
 
         # Process imports throughout the entire tree
+        xmlpp_loading.append(xmlpp_source)
         xmlpp_process_imports(xmlpp_root, xmlpp_source)
+        xmlpp_loading.pop()
 
         #xmlpp_dump_el(xmlpp_root,"root")
         return xmlpp_tree
 
+    def xmlpp_print_graph(xmlpp_path, xmlpp_indent, xmlpp_printed):
+        # Prints xmlpp_path, and (once only) the files it imports, to the debug file.
+        xmlpp_again = xmlpp_path in xmlpp_printed and xmlpp_path in xmlpp_graph
+        print(f"{' ' * xmlpp_indent}{xmlpp_path}{' (imports shown above)' if xmlpp_again else ''}", file=xmlpp_debug_file)
+        if xmlpp_again: return
+        xmlpp_printed.add(xmlpp_path)
+        for xmlpp_child_path in xmlpp_graph.get(xmlpp_path, []):
+            xmlpp_print_graph(xmlpp_child_path, xmlpp_indent + 3, xmlpp_printed)
+
     xmlpp_phase_printer.print("loading source file(s)")
-    return xmlpp_load_tree(xmlpp_source)
+    xmlpp_tree = xmlpp_load_tree(xmlpp_source)
+    if xmlpp_DEBUG and xmlpp_graph:
+        print("   Imported files:", file=xmlpp_debug_file)
+        xmlpp_print_graph(xmlpp_source, 6, set())
+    return xmlpp_tree
 
 def xmlpp_dump_el(xmlpp_el, xmlpp_el_name, xmlpp_indent=0):     # used with xmlpp_DEBUG
     def xmlpp_dump_recurse(xmlpp_el, xmlpp_indent=0):
@@ -189,115 +1008,200 @@ def xmlpp_extract_symbols():    # put all <Symbol> elements in xmlpp_symbol_els[
         if xmlpp_parent is None: raise xmlpp_error("Can't remove a <Symbol> because it is the root element", xmlpp_parent)
         xmlpp_parent.remove(xmlpp_el)
 
+def xmlpp_use_href(xmlpp_use_el):
+    # Returns the id of the <Symbol> that <Use> xmlpp_use_el refers to.
+    xmlpp_href = xmlpp_use_el.get("href")
+    return xmlpp_href[1:] if xmlpp_href[0] == '#' else xmlpp_href     # [1:] strips # from href
+
+def xmlpp_is_tailored_use(xmlpp_el):
+    # Returns True if xmlpp_el is a <Use> with <Delete>s or <Transform>s.
+    return xmlpp_el.tag == "Use" and (xmlpp_el.find("Delete") is not None or xmlpp_el.find("Transform") is not None)
+
+def xmlpp_expanded_symbol(xmlpp_id, xmlpp_use_el):
+    # Returns the <Symbol> with id xmlpp_id, after replacing most nested <Use>s in it. Nested <Use>s are only
+    # replaced the first time, so that isn't repeated for every <Use> of the <Symbol>. This gives the same result
+    # as replacing them in each copy, because the <Use>'s attributes are passed on by nested <Use>s at the top
+    # level of the <Symbol>, and its <Delete>s and <Transform>s were always applied after nested <Use>s were replaced.
+    # The exception is a <Use> at the top level of the <Symbol> with its own <Delete>s or <Transform>s: these must be
+    # applied after the outer <Use>'s attributes (which can change what they select, or be overridden by them), so such
+    # <Use>s are left for xmlpp_instantiate_use() to replace in each copy.
+    # Don't modify the returned element; copy it.
+    if xmlpp_id not in xmlpp_symbols: raise xmlpp_error(f"Can't find <Symbol id=\"{xmlpp_id}\" />", xmlpp_use_el)
+    xmlpp_symbol = xmlpp_symbols[xmlpp_id]
+    xmlpp_expanded = xmlpp_symbol_expansion.get(xmlpp_id)
+    if xmlpp_expanded is False:
+        raise xmlpp_error(f"<Symbol id=\"{xmlpp_id}\"> contains a <Use> of itself (perhaps via other <Symbol>s)", xmlpp_use_el)
+    if xmlpp_expanded is None:
+        xmlpp_symbol_expansion[xmlpp_id] = False
+        for xmlpp_child_el in list(xmlpp_symbol):
+            if xmlpp_is_tailored_use(xmlpp_child_el):
+                xmlpp_expanded_symbol(xmlpp_use_href(xmlpp_child_el), xmlpp_child_el)    # so its nested <Use>s (and any cycle) are dealt with now
+            elif xmlpp_child_el.tag == "Use":
+                xmlpp_replace_use(xmlpp_symbol, xmlpp_child_el)
+            else:
+                xmlpp_replace_uses(xmlpp_child_el)
+        xmlpp_symbol_expansion[xmlpp_id] = True
+    return xmlpp_symbol
+
+xmlpp_SIMPLE_PATH_REGEXP = re.compile(r'(?:\.//(?:\*|[A-Za-z_][\w-]*)|\*|\.|[A-Za-z_][\w-]*)(?://?(?:\*|[A-Za-z_][\w-]*))*')    # eg, './/Group/Rect'
+xmlpp_selectors = {}    # compiled XPath, or None to use findall(), indexed by [<Delete>/<Transform> href]
+
+def xmlpp_select(xmlpp_el, xmlpp_href):
+    # Returns list of elements in xmlpp_el that match ElementPath xmlpp_href, as xmlpp_el.findall(xmlpp_href) would,
+    # but possibly in a different order, and without duplicates (neither matters to <Delete> or <Transform>).
+    # Simple paths (tags and * separated by / or //) select the same elements in XPath, which lxml evaluates faster, so
+    # they're compiled (once per href) to XPath; anything else uses findall() (eg, predicates match text slightly
+    # differently).
+    xmlpp_xpath = xmlpp_selectors.get(xmlpp_href, False)
+    if xmlpp_xpath is False:
+        xmlpp_xpath = None
+        if xmlpp_SIMPLE_PATH_REGEXP.fullmatch(xmlpp_href):
+            try:
+                xmlpp_xpath = xmlpp_ET.XPath(xmlpp_href)
+            except xmlpp_ET.XPathError:
+                pass
+        xmlpp_selectors[xmlpp_href] = xmlpp_xpath
+    if xmlpp_xpath is not None:
+        return xmlpp_xpath(xmlpp_el)
+    return xmlpp_el.findall(xmlpp_href)
+
+def xmlpp_instantiate_use(xmlpp_el, xmlpp_use_el):
+    # Removes xmlpp_use_el from its parent, xmlpp_el, and returns a copy of the <Symbol> it refers to,
+    # tailored by the <Use>'s attributes, <Delete>s and <Transform>s. Nested <Use>s in the copy are replaced.
+    xmlpp_href = xmlpp_use_href(xmlpp_use_el)
+    if xmlpp_DEBUG: print(f'   Replacing <Use href="#{xmlpp_href}">', file=xmlpp_debug_file)
+    xmlpp_symbol = xmlpp_expanded_symbol(xmlpp_href, xmlpp_use_el)
+    xmlpp_delete_list = xmlpp_use_el.findall("Delete")
+    xmlpp_transform_list = xmlpp_use_el.findall("Transform")
+    #print(len(xmlpp_transform_list))
+
+    # Remove <Use> el and any <Transform>s and <Delete>s within it:
+    xmlpp_el.remove(xmlpp_use_el)
+
+    # Clone <Symbol> so <Transform>s don't affect original <Symbol> or subsequent <Use>s:
+    xmlpp_symbol_copy = copy.deepcopy(xmlpp_symbol)
+    if xmlpp_DEBUG: xmlpp_dump_el(xmlpp_symbol_copy, "xmlpp_symbol_copy", 6)
+
+    # Apply attributes specified in <Use> to all top-level elements in copy:
+    #print(xmlpp_el.attrib)
+    for xmlpp_symbol_el in xmlpp_symbol_copy:
+        for xmlpp_attrib_name, xmlpp_attrib_value in xmlpp_use_el.attrib.items():
+            if xmlpp_attrib_name != "href":
+                if xmlpp_DEBUG: print(f'      Setting attribute "{xmlpp_attrib_name}" on <{xmlpp_symbol_el.tag}>', file=xmlpp_debug_file)
+                xmlpp_symbol_el.set(xmlpp_attrib_name, xmlpp_attrib_value)
+
+    # Replace nested <Use>s that xmlpp_expanded_symbol() left because they have their own <Delete>s or <Transform>s:
+    for xmlpp_symbol_el in list(xmlpp_symbol_copy):
+        if xmlpp_symbol_el.tag == "Use": xmlpp_replace_use(xmlpp_symbol_copy, xmlpp_symbol_el)
+
+    # Apply any <Delete> elements. They're applied in order, as are <Transform>s, because an href can match elements
+    # differently after an earlier <Delete> or <Transform> (eg, if it selects by attribute value):
+    for xmlpp_delete in xmlpp_delete_list:
+        if xmlpp_DEBUG: print(f'      Applying <Delete href="{xmlpp_delete.attrib["href"]}">', file=xmlpp_debug_file)
+        try:
+            xmlpp_delete_els = xmlpp_select(xmlpp_symbol_copy, xmlpp_delete.attrib["href"])
+        except Exception as e:
+            raise xmlpp_error(f"{type(e).__name__} applying <Delete href=\"{xmlpp_delete.attrib['href']}\">: {sys.exception()}. href may be invalid.")
+        if len(xmlpp_delete_els) == 0:
+            raise xmlpp_error(f'Can\'t find any element to <Delete> with href="{xmlpp_delete.attrib["href"]}"')
+        for xmlpp_delete_el in xmlpp_delete_els:
+            xmlpp_parent = xmlpp_delete_el.getparent()
+            if xmlpp_parent is None:
+                raise xmlpp_error(f'<Delete href="{xmlpp_delete.attrib["href"]}"> can\'t delete the whole <Symbol>')
+            xmlpp_parent.remove(xmlpp_delete_el)
+            if xmlpp_DEBUG: print("         Deleted an element", file=xmlpp_debug_file)
+
+    # Apply any <Transform> elements:
+    for xmlpp_transform in xmlpp_transform_list:
+        if xmlpp_DEBUG:
+            print(f'      Applying <Transform href="{xmlpp_transform.attrib["href"]}" target="{xmlpp_transform.attrib["target"]}"...>', file=xmlpp_debug_file)
+        try:
+            xmlpp_transform_els = xmlpp_select(xmlpp_symbol_copy, xmlpp_transform.attrib["href"])
+        except Exception as e:
+            raise xmlpp_error(f"{type(e).__name__} applying <Transform href=\"{xmlpp_transform.attrib['href']}\"...: {sys.exception()}. href may be invalid.")
+
+        if len(xmlpp_transform_els) == 0:
+            raise xmlpp_error(f'Can\'t find any element to <Transform> with href="{xmlpp_transform.attrib["href"]}"')
+        for xmlpp_transform_el in xmlpp_transform_els:
+            xmlpp_transform_el.set(xmlpp_transform.attrib["target"], xmlpp_transform.attrib["value"])
+            if xmlpp_DEBUG: print("         Transformed an element", file=xmlpp_debug_file)
+
+    return xmlpp_symbol_copy
+
+def xmlpp_replace_use(xmlpp_el, xmlpp_use_el):
+    # Replaces <Use> xmlpp_use_el, which is a child of xmlpp_el, with a copy of its <Symbol>'s content.
+    # Returns the first element inserted, or the element that followed xmlpp_use_el if none was (None if there's none).
+    # Insert copy of <Symbol>, potentially modified by <Transform>s, into tree:
+    xmlpp_next_el = xmlpp_use_el.getnext()
+    xmlpp_symbol_copy = xmlpp_instantiate_use(xmlpp_el, xmlpp_use_el)
+    xmlpp_first_el = None
+    for xmlpp_symbol_el in list(xmlpp_symbol_copy):     # nested <Use>s have already been replaced
+        if xmlpp_next_el is None: xmlpp_el.append(xmlpp_symbol_el)
+        else: xmlpp_next_el.addprevious(xmlpp_symbol_el)
+        if xmlpp_first_el is None: xmlpp_first_el = xmlpp_symbol_el
+    return xmlpp_next_el if xmlpp_first_el is None else xmlpp_first_el
+
+def xmlpp_replace_uses(xmlpp_el):
+    # Replaces all <Use>s under xmlpp_el. Recursive.
+    # Works on a list of children rather than by index, because lxml's len() and [] take time proportional to the
+    # number of children, and there can be a great many of them (eg, after lots of <Use>s of the same <Symbol>).
+    for xmlpp_child_el in list(xmlpp_el):
+        if xmlpp_child_el.tag == "Use":
+            if xmlpp_deferred_uses is not None and (xmlpp_el is xmlpp_root or xmlpp_el.getparent() is xmlpp_root):
+                xmlpp_deferred_uses.add(xmlpp_child_el)     # see xmlpp_deferred_uses
+            else:
+                xmlpp_replace_use(xmlpp_el, xmlpp_child_el)
+        else:   # Not <Use>
+            xmlpp_replace_uses(xmlpp_child_el)   # recurse
+
 def xmlpp_replace_all_uses(): # replace all <Use> elements
     xmlpp_phase_printer.print("replacing <Use>s with <Symbol>s")
-
-    def xmlpp_replace_use(xmlpp_el):
-        # Recursive.
-        xmlpp_index = 0
-        while xmlpp_index < len(xmlpp_el):
-            xmlpp_child_el = xmlpp_el[xmlpp_index]
-            if xmlpp_child_el.tag == "Use":
-                xmlpp_href = xmlpp_child_el.get("href")
-                if xmlpp_href[0] == '#': xmlpp_href = xmlpp_href[1:]     # [1:] strips # from href
-                if xmlpp_DEBUG: print(f'   Replacing <Use href="#{xmlpp_href}">', file=xmlpp_debug_file)
-                if xmlpp_href not in xmlpp_symbols: raise xmlpp_error(f"Can't find <Symbol id=\"{xmlpp_href}\" />", xmlpp_child_el)
-                xmlpp_symbol = xmlpp_symbols[xmlpp_href]
-                xmlpp_delete_list = xmlpp_child_el.findall("Delete")
-                xmlpp_transform_list = xmlpp_child_el.findall("Transform")
-                #print(len(xmlpp_transform_list))
-
-                # Remove <Use> el and any <Transform>s and <Delete>s within it:
-                xmlpp_el.remove(xmlpp_child_el)
-
-                # Clone <Symbol> so <Transform>s don't affect original <Symbol> or subsequent <Use>s:
-                xmlpp_symbol_copy = copy.deepcopy(xmlpp_symbol)
-                if xmlpp_DEBUG: xmlpp_dump_el(xmlpp_symbol_copy, "xmlpp_symbol_copy", 6)
-
-                # Apply attributes specified in <Use> to all top-level elements in copy:
-                #print(xmlpp_el.attrib)
-                for xmlpp_symbol_el in xmlpp_symbol_copy:
-                    for xmlpp_attrib_name, xmlpp_attrib_value in xmlpp_child_el.attrib.items():
-                        if xmlpp_attrib_name != "href":
-                            if xmlpp_DEBUG: print(f'      Setting attribute "{xmlpp_attrib_name}" on <{xmlpp_symbol_el.tag}>', file=xmlpp_debug_file)
-                            xmlpp_symbol_el.set(xmlpp_attrib_name, xmlpp_attrib_value)
-
-                # recurse, just in case <Symbol> contains nested <Use>s:
-                xmlpp_replace_use(xmlpp_symbol_copy)
-
-                # Apply any <Delete> elements:
-                if xmlpp_delete_list:
-                    for xmlpp_delete in xmlpp_delete_list:
-                        if xmlpp_DEBUG: print(f'      Applying <Delete href="{xmlpp_delete.attrib["href"]}">', file=xmlpp_debug_file)
-                        xmlpp_delete_els = xmlpp_symbol_copy.findall(xmlpp_delete.attrib["href"])
-                        if len(xmlpp_delete_els) == 0:
-                            raise xmlpp_error(f'Can\'t find any element to <Delete> with href="{xmlpp_delete.attrib["href"]}"')
-                        for xmlpp_delete_el in xmlpp_delete_els:
-                            xmlpp_parent = xmlpp_symbol_copy.find(xmlpp_delete.attrib["href"]+"/..")
-                            xmlpp_parent.remove(xmlpp_delete_el)
-                            if xmlpp_DEBUG: print("         Deleted an element", file=xmlpp_debug_file)
-
-                # Apply any <Transform> elements:
-                if xmlpp_transform_list:
-                    for xmlpp_transform in xmlpp_transform_list:
-                        if xmlpp_DEBUG:
-                            print(f'      Applying <Transform href="{xmlpp_transform.attrib["href"]}" target="{xmlpp_transform.attrib["target"]}"...>', file=xmlpp_debug_file)
-                        try:
-                            xmlpp_transform_els = xmlpp_symbol_copy.findall(xmlpp_transform.attrib["href"])
-                        except Exception as e:
-                            raise xmlpp_error(f"{type(e).__name__} applying <Transform href=\"{xmlpp_transform.attrib['href']}\"...: {sys.exception()}. href may be invalid.")
-
-                        if len(xmlpp_transform_els) == 0:
-                            raise xmlpp_error(f'Can\'t find any element to <Transform> with href="{xmlpp_transform.attrib["href"]}"')
-                        for xmlpp_transform_el in xmlpp_transform_els:
-                            xmlpp_transform_el.set(xmlpp_transform.attrib["target"], xmlpp_transform.attrib["value"])
-                            if xmlpp_DEBUG: print("         Transformed an element", file=xmlpp_debug_file)
-
-                # Insert copy of <Symbol>, potentially modified by <Transform>s, into tree:
-                xmlpp_index = xmlpp_insert(xmlpp_el, xmlpp_index, xmlpp_symbol_copy, True)
-            else:   # Not <Use>
-                xmlpp_replace_use(xmlpp_child_el)   # recurse
-                xmlpp_index += 1
-
-    xmlpp_replace_use(xmlpp_root)
+    xmlpp_replace_uses(xmlpp_root)
+
+def xmlpp_expand_repeat(xmlpp_el, xmlpp_index, xmlpp_repeat_el):
+    # Replaces xmlpp_repeat_el, which is xmlpp_el[xmlpp_index], with a <Define> that sets the loop variable
+    # followed by a copy of xmlpp_repeat_el's children, for every iteration.
+    def xmlpp_insert_repeat(xmlpp_parent_el, xmlpp_repeat_els, xmlpp_index, xmlpp_for_var, xmlpp_for_val):
+        # Returns final value of xmlpp_index.
+        xmlpp_define_el = xmlpp_ET.Element('Define')
+        xmlpp_define_el.text = f"{xmlpp_for_var}={xmlpp_for_val}"   # eg, "i=0"
+        #print(f"inserting Define at {xmlpp_index}")
+        xmlpp_parent_el.insert(xmlpp_index, xmlpp_define_el)
+        xmlpp_index += 1
+        # Insert xmlpp_repeat_els:
+        for xmlpp_child_el in xmlpp_repeat_els:
+            #print(f"inserting content at {xmlpp_index}")
+            xmlpp_parent_el.insert(xmlpp_index, copy.deepcopy(xmlpp_child_el))  # deepcopy because lxml el can only have one parent
+            xmlpp_index += 1
+        return xmlpp_index
+
+    if "for" not in xmlpp_repeat_el.attrib: raise xmlpp_error("<Repeat> missing 'for' attribute.", xmlpp_repeat_el)
+    xmlpp_for = xmlpp_repeat_el.attrib["for"]
+    if "in" not in xmlpp_repeat_el.attrib: raise xmlpp_error("<Repeat> missing 'in' attribute.", xmlpp_repeat_el)
+    xmlpp_in = xmlpp_repeat_el.attrib["in"]
+    if (xmlpp_DEBUG): print(f'   Expanding <Repeat for="{xmlpp_for}" in="{xmlpp_in}">', file=xmlpp_debug_file)
+    xmlpp_repeat_els = list(xmlpp_repeat_el)   # every iteration inserts copies of these, so they needn't be copied here
+    xmlpp_el.remove(xmlpp_repeat_el)     # remove the <Repeat> element itself
+    try:
+        xmlpp_check_strict(f"for {xmlpp_for} in {xmlpp_in}: pass", 'exec')
+    except ValueError as e:
+        raise xmlpp_error(f"{type(e).__name__} evaluating <Repeat for=\"{xmlpp_for}\" in=\"{xmlpp_in}\">: {sys.exception()}", xmlpp_repeat_el)
+    # construct a string that contains the code to be executed in order to create the required number of copies:
+    xmlpp_repeat_code = f'for {xmlpp_for} in {xmlpp_in}: xmlpp_index = xmlpp_insert_repeat(xmlpp_el, xmlpp_repeat_els, xmlpp_index, "{xmlpp_for}", {xmlpp_for})'
+    #print(f"before exec: {xmlpp_index}")
+    exec(xmlpp_repeat_code, xmlpp_namespace, locals())
+    #print(f"after exec: {xmlpp_index}")
 
 def xmlpp_expand_all_repeats(): # expand all <Repeat> elements
     xmlpp_phase_printer.print("expanding <Repeat> elements")
 
     def xmlpp_expand_repeats(xmlpp_el):
-        def xmlpp_insert_repeat(xmlpp_parent_el, xmlpp_repeat_els, xmlpp_index, xmlpp_for_var, xmlpp_for_val):
-            # Returns final value of xmlpp_index.
-            xmlpp_define_el = xmlpp_ET.Element('Define')
-            xmlpp_define_el.text = f"{xmlpp_for_var}={xmlpp_for_val}"   # eg, "i=0"
-            #print(f"inserting Define at {xmlpp_index}")
-            xmlpp_parent_el.insert(xmlpp_index, xmlpp_define_el)
-            xmlpp_index += 1
-            # Insert xmlpp_repeat_els:
-            for xmlpp_child_el in xmlpp_repeat_els:
-                #print(f"inserting content at {xmlpp_index}")
-                xmlpp_parent_el.insert(xmlpp_index, copy.deepcopy(xmlpp_child_el))  # deepcopy because lxml el can only have one parent
-                xmlpp_index += 1
-            return xmlpp_index
-
         xmlpp_index = 0
         while xmlpp_index < len(xmlpp_el):
             xmlpp_child_el = xmlpp_el[xmlpp_index]
             # print(xmlpp_child_el.tag)
             if xmlpp_child_el.tag == "Repeat":
-                if "for" not in xmlpp_child_el.attrib: xmlpp_error("<Repeat> missing 'for' attribute.")
-                xmlpp_for = xmlpp_child_el.attrib["for"]
-                if "in" not in xmlpp_child_el.attrib: xmlpp_error("<Repeat> missing 'in' attribute.")
-                xmlpp_in = xmlpp_child_el.attrib["in"]
-                if (xmlpp_DEBUG): print(f'   Expanding <Repeat for="{xmlpp_for}" in="{xmlpp_in}">', file=xmlpp_debug_file)
-                xmlpp_repeat_els = []
-                for xmlpp_repeat_el in xmlpp_child_el:  # make deep copy of each xmlpp_child_el because lxml wants each el to have its own parent
-                    xmlpp_repeat_els.append(copy.deepcopy(xmlpp_repeat_el))
-                xmlpp_el.remove(xmlpp_child_el)     # remove the <Repeat> element itself
-                # construct a string that contains the code to be executed in order to create the required number of copies:
-                xmlpp_repeat_code = f'for {xmlpp_for} in {xmlpp_in}: xmlpp_index = xmlpp_insert_repeat(xmlpp_el, xmlpp_repeat_els, xmlpp_index, "{xmlpp_for}", {xmlpp_for})'
-                #print(f"before exec: {xmlpp_index}")
-                exec(xmlpp_repeat_code, globals(), locals())
-                #print(f"after exec: {xmlpp_index}")
+                xmlpp_expand_repeat(xmlpp_el, xmlpp_index, xmlpp_child_el)
                 xmlpp_index += 1    # skip over the <Define>, but process the newly-copied elements in case they contain nested <Repeat>s
             else:   # xmlpp_child_el is not <Repeat>
                 xmlpp_expand_repeats(xmlpp_child_el)    # recurse
@@ -305,172 +1209,258 @@ def xmlpp_expand_all_repeats(): # expand all <Repeat> elements
 
     xmlpp_expand_repeats(xmlpp_root)
 
-def xmlpp_do_defines_and_expressions(): # execute <Define>s and replace all {expression}s with their results
-    xmlpp_phase_printer.print("processing <Define>s and {expression}s...")
-
-    def xmlpp_exec_definitions(xmlpp_text, xmlpp_el):
-        def xmlpp_find_indent_size(xmlpp_firstLine):
-            for xmlpp_index, xmlpp_char in enumerate(xmlpp_firstLine):
-                if xmlpp_char != ' ':
-                    return xmlpp_index
-            return -1   # all characters are spaces
-
-        # Remove first line (text following <Define>):
-        xmlpp_firstEOLindex = xmlpp_text.find('\n')
-        if xmlpp_firstEOLindex != -1:
-            xmlpp_text = xmlpp_text[xmlpp_firstEOLindex+1:]
-        if not xmlpp_text.isspace():
+def xmlpp_exec_definitions(xmlpp_text, xmlpp_el, xmlpp_line):
+    # Executes Python code xmlpp_text, from the text or tail of <Define> element xmlpp_el, which starts on line xmlpp_line
+    # of the file the <Define> is in (0 if the first line is just the newline added to imported .py files).
+    def xmlpp_find_indent_size(xmlpp_firstLine):
+        for xmlpp_index, xmlpp_char in enumerate(xmlpp_firstLine):
+            if xmlpp_char != ' ':
+                return xmlpp_index
+        return -1   # all characters are spaces
+
+    # Remove first line (text following <Define>):
+    xmlpp_firstEOLindex = xmlpp_text.find('\n')
+    if xmlpp_firstEOLindex != -1:
+        xmlpp_text = xmlpp_text[xmlpp_firstEOLindex+1:]
+        xmlpp_line += 1
+    if not xmlpp_text.isspace():
+        xmlpp_filename = xmlpp_el.get('xmlpp-file', '<Define>')
+        xmlpp_key = xmlpp_code_cache.key(xmlpp_text, xmlpp_filename, xmlpp_line)
+        xmlpp_code = xmlpp_code_cache.get(xmlpp_key)
+        if xmlpp_code is None or xmlpp_DEBUG:   # dedent xmlpp_text
             xmlpp_lines = xmlpp_text.split('\n')
             xmlpp_indent_size = xmlpp_find_indent_size(xmlpp_lines[0])
             xmlpp_processed_lines = []
-            for xmlpp_line in xmlpp_lines:
-                xmlpp_processed_line = xmlpp_line[xmlpp_indent_size:] if xmlpp_line.startswith(' ' * xmlpp_indent_size) else xmlpp_line.lstrip()
+            for xmlpp_line_text in xmlpp_lines:
+                xmlpp_processed_line = xmlpp_line_text[xmlpp_indent_size:] if xmlpp_line_text.startswith(' ' * xmlpp_indent_size) else xmlpp_line_text.lstrip()
                 xmlpp_processed_lines.append(xmlpp_processed_line)
             xmlpp_text = '\n'.join(xmlpp_processed_lines)
             #print("Indent size: ",xmlpp_indent_size)
             #print("Before strip:\n\""+el.text+"\"")
             #print("After strip:\n\""+xmlpp_text+"\"\n")
             if xmlpp_DEBUG: print("\n".join(["   <Define>: executing " + line for line in xmlpp_text.split("\n")]), file=xmlpp_debug_file)
-            try:
-                exec(xmlpp_text, globals())
-            except Exception as e:
-                raise xmlpp_error(f"{type(e).__name__} executing code in <Define>: {sys.exception()}", xmlpp_el)
-
-    def xmlpp_evalStringWithExpressions(xmlpp_el, xmlpp_s, xmlpp_attrib_name=None):
-        # If the string is an expression that returns an XML Element, the Element is returned.
-        # Otherwise, returns string with expressions replaced by values, or False if no expressions found.
-
-        def xmlpp_eval_parent(xmlpp_el, xmlpp_exp, xmlpp_attrib_name):
-            # Returns arg with PARENT.attrib replaced by value of attrib in parent element.
-            # If .attrib isn't specified, uses xmlpp_attrib_name.
-
-            def xmlpp_eval_parent_terms(xmlpp_exp, xmlpp_regexp, xmlpp_attrib_name=None):
-                def xmlpp_eval_parent_attrib(xmlpp_el, xmlpp_parent_attrib):
-                    # Recurses; returns None if no ancestor has a value for xmlpp_parent_attrib.
-                    if xmlpp_DEBUG: print(f'      Looking for <{xmlpp_el.tag} {xmlpp_parent_attrib}="...">', file=xmlpp_debug_file)
-                    xmlpp_parent_el = xmlpp_el.getparent()
-                    if xmlpp_parent_el is None: return None
-                    xmlpp_parent_value = xmlpp_parent_el.get(xmlpp_parent_attrib)
-                    if xmlpp_parent_value != None:
-                        return xmlpp_parent_value
-                    else:
-                        return xmlpp_eval_parent_attrib(xmlpp_parent_el, xmlpp_parent_attrib)   # recurse
-
-                # Returns string with PARENT terms replaced.
-                xmlpp_matches = re.split(xmlpp_regexp, xmlpp_exp)
-                #print(xmlpp_exp,xmlpp_matches)
-                # Process all odd-numbered matches[]:
-                for xmlpp_matchIndex in range(1, len(xmlpp_matches), 2):
-                    xmlpp_parent_attrib = xmlpp_attrib_name if xmlpp_attrib_name else xmlpp_matches[xmlpp_matchIndex].split('.')[1]
-                    #print(xmlpp_parent_attrib)
-                    xmlpp_attrib_value = xmlpp_eval_parent_attrib(xmlpp_el, xmlpp_parent_attrib)
-                    if xmlpp_attrib_value == None:
-                        raise xmlpp_error('Can\'t find any PARENT of {0} with attribute named "{1}"'.format(xmlpp_el.tag, xmlpp_parent_attrib), xmlpp_el)
-                    xmlpp_matches[xmlpp_matchIndex] = xmlpp_attrib_value
-                return "".join(xmlpp_matches)
-
-            # Process PARENT.attribName terms:
-            xmlpp_exp = xmlpp_eval_parent_terms(xmlpp_exp, r'(PARENT\.[a-zA-Z-]+)')
-
-            # Process PARENT (without attribName) terms:
-            xmlpp_exp = xmlpp_eval_parent_terms(xmlpp_exp, r'(PARENT)', xmlpp_attrib_name)
-
-            # Process SELF.attribName terms:
-            #print('processing SELF...')
-            xmlpp_matches = re.split(r'(SELF\.[a-zA-Z-]+)', xmlpp_exp)
+        if xmlpp_profiler is not None: xmlpp_start = time.perf_counter()
+        try:
+            if xmlpp_code is None: xmlpp_code = xmlpp_code_cache.compile(xmlpp_key, xmlpp_text, xmlpp_filename, xmlpp_line)
+            exec(xmlpp_code, xmlpp_namespace)
+        except Exception as e:
+            # Report the line of the <Define>'s file that the problem is on (SyntaxError messages already include it):
+            import traceback
+            xmlpp_lines = [xmlpp_frame.lineno for xmlpp_frame in traceback.extract_tb(e.__traceback__) if xmlpp_frame.filename == xmlpp_filename]
+            xmlpp_where = f" (line {xmlpp_lines[-1]} of {xmlpp_filename})" if xmlpp_lines and not isinstance(e, SyntaxError) else ""
+            raise xmlpp_error(f"{type(e).__name__} executing code in <Define>{xmlpp_where}: {sys.exception()}", xmlpp_el)
+        if xmlpp_profiler is not None:
+            xmlpp_profiler.add("<Define>", xmlpp_el, xmlpp_text.strip().split('\n')[0], time.perf_counter() - xmlpp_start)
+
+def xmlpp_exec_define(xmlpp_el):
+    # Executes the content of <Define> element xmlpp_el.
+    xmlpp_line = xmlpp_el.sourceline or 0   # <Define>s made for imported .py files don't have a sourceline
+    if (xmlpp_el.text): xmlpp_exec_definitions(xmlpp_el.text, xmlpp_el, xmlpp_line)
+    if (xmlpp_el.tail):     # TODO 3.9 is this sensible?
+        xmlpp_exec_definitions(xmlpp_el.tail, xmlpp_el, xmlpp_line + (xmlpp_el.text or '').count('\n'))
+
+def xmlpp_parent_attrib_value(xmlpp_el, xmlpp_parent_attrib):
+    # Returns value of xmlpp_parent_attrib in xmlpp_el's nearest ancestor that has it.
+    # Recurses; returns None if no ancestor has a value for xmlpp_parent_attrib.
+    if xmlpp_inherited_attribs is not None:
+        if xmlpp_DEBUG: print(f'      Looking up inherited {xmlpp_parent_attrib}="..."', file=xmlpp_debug_file)
+        return xmlpp_inherited_attribs.get(xmlpp_parent_attrib)
+    if xmlpp_DEBUG: print(f'      Looking for <{xmlpp_el.tag} {xmlpp_parent_attrib}="...">', file=xmlpp_debug_file)
+    xmlpp_parent_el = xmlpp_el.getparent()
+    if xmlpp_parent_el is None: return None
+    xmlpp_parent_value = xmlpp_parent_el.get(xmlpp_parent_attrib)
+    if xmlpp_parent_value != None:
+        return xmlpp_parent_value
+    else:
+        return xmlpp_parent_attrib_value(xmlpp_parent_el, xmlpp_parent_attrib)   # recurse
+
+def xmlpp_evalStringWithExpressions(xmlpp_el, xmlpp_s, xmlpp_attrib_name=None):
+    # If the string is an expression that returns an XML Element, the Element is returned.
+    # Otherwise, returns string with expressions replaced by values, or False if no expressions found.
+
+    def xmlpp_parameter_values(xmlpp_el, xmlpp_pieces, xmlpp_attrib_name):
+        # Returns the values of the PARENT/SELF terms in xmlpp_pieces (see xmlpp_ExpressionCache.parameterise()),
+        # or None if any can't be found or isn't a plain number; the expression must then be substituted as text.
+        xmlpp_values = []
+        for xmlpp_piece in xmlpp_pieces:
+            if isinstance(xmlpp_piece, str): continue
+            xmlpp_kind, xmlpp_name = xmlpp_piece
+            if xmlpp_kind == 'SELF': xmlpp_value = xmlpp_el.get(xmlpp_name)
+            elif xmlpp_name or xmlpp_attrib_name: xmlpp_value = xmlpp_parent_attrib_value(xmlpp_el, xmlpp_name or xmlpp_attrib_name)
+            else: return None
+            if xmlpp_value is None or not xmlpp_NUMBER_REGEXP.fullmatch(xmlpp_value): return None
+            xmlpp_values.append(xmlpp_value)
+        return xmlpp_values
+
+    def xmlpp_eval_parent(xmlpp_el, xmlpp_exp, xmlpp_attrib_name):
+        # Returns arg with PARENT.attrib replaced by value of attrib in parent element.
+        # If .attrib isn't specified, uses xmlpp_attrib_name.
+
+        def xmlpp_eval_parent_terms(xmlpp_exp, xmlpp_regexp, xmlpp_attrib_name=None):
+            # Returns string with PARENT terms replaced.
+            xmlpp_matches = xmlpp_regexp.split(xmlpp_exp)
             #print(xmlpp_exp,xmlpp_matches)
             # Process all odd-numbered matches[]:
             for xmlpp_matchIndex in range(1, len(xmlpp_matches), 2):
-                xmlpp_self_attrib = xmlpp_matches[xmlpp_matchIndex].split('.')[1]
-                xmlpp_attrib_value = xmlpp_el.get(xmlpp_self_attrib)
+                xmlpp_parent_attrib = xmlpp_attrib_name if xmlpp_attrib_name else xmlpp_matches[xmlpp_matchIndex].split('.')[1]
+                #print(xmlpp_parent_attrib)
+                xmlpp_attrib_value = xmlpp_parent_attrib_value(xmlpp_el, xmlpp_parent_attrib)
                 if xmlpp_attrib_value == None:
-                    raise xmlpp_error('Can\'t find {0} SELF attribute named "{1}"'.format(xmlpp_el.tag, xmlpp_self_attrib), xmlpp_el)
-                #print(f"   {xmlpp_self_attrib}={xmlpp_attrib_value}")
+                    raise xmlpp_error('Can\'t find any PARENT of {0} with attribute named "{1}"'.format(xmlpp_el.tag, xmlpp_parent_attrib), xmlpp_el)
                 xmlpp_matches[xmlpp_matchIndex] = xmlpp_attrib_value
-            xmlpp_exp = "".join(xmlpp_matches)
-            #print(f'done: {xmlpp_exp}')
+            return "".join(xmlpp_matches)
 
-            return xmlpp_exp
+        # Process PARENT.attribName terms:
+        xmlpp_exp = xmlpp_eval_parent_terms(xmlpp_exp, xmlpp_PARENT_ATTRIB_REGEXP)
 
-        xmlpp_matches = re.split(r'(\{.*?\})', xmlpp_s)     # TODO 3.9 doesn't work if {} has \n
-        if (len(xmlpp_matches) <= 1):
-            return False    # no {}
-        if (xmlpp_DEBUG): print(f'   Evaluating: <{xmlpp_el.tag} {xmlpp_attrib_name}="{xmlpp_s}">', file=xmlpp_debug_file)
+        # Process PARENT (without attribName) terms:
+        xmlpp_exp = xmlpp_eval_parent_terms(xmlpp_exp, xmlpp_PARENT_REGEXP, xmlpp_attrib_name)
+
+        # Process SELF.attribName terms:
+        #print('processing SELF...')
+        xmlpp_matches = xmlpp_SELF_ATTRIB_REGEXP.split(xmlpp_exp)
+        #print(xmlpp_exp,xmlpp_matches)
         # Process all odd-numbered matches[]:
         for xmlpp_matchIndex in range(1, len(xmlpp_matches), 2):
-            xmlpp_exp = xmlpp_matches[xmlpp_matchIndex][1:-1]   # [1:-1] strips { }
-            xmlpp_exp = xmlpp_eval_parent(xmlpp_el, xmlpp_exp, xmlpp_attrib_name)
+            xmlpp_self_attrib = xmlpp_matches[xmlpp_matchIndex].split('.')[1]
+            xmlpp_attrib_value = xmlpp_el.get(xmlpp_self_attrib)
+            if xmlpp_attrib_value == None:
+                raise xmlpp_error('Can\'t find {0} SELF attribute named "{1}"'.format(xmlpp_el.tag, xmlpp_self_attrib), xmlpp_el)
+            #print(f"   {xmlpp_self_attrib}={xmlpp_attrib_value}")
+            xmlpp_matches[xmlpp_matchIndex] = xmlpp_attrib_value
+        xmlpp_exp = "".join(xmlpp_matches)
+        #print(f'done: {xmlpp_exp}')
+
+        return xmlpp_exp
+
+    if '{' not in xmlpp_s: return False     # no {}
+    xmlpp_segments = xmlpp_expression_cache.split(xmlpp_s)
+    if xmlpp_segments is None:
+        return False    # no {}
+    xmlpp_matches = list(xmlpp_segments)    # copy, because cached segments are shared
+    if (xmlpp_DEBUG): print(f'   Evaluating: <{xmlpp_el.tag} {xmlpp_attrib_name}="{xmlpp_s}">', file=xmlpp_debug_file)
+    # Process all odd-numbered matches[]:
+    for xmlpp_matchIndex in range(1, len(xmlpp_matches), 2):
+        xmlpp_exp, xmlpp_has_context = xmlpp_matches[xmlpp_matchIndex]
+        xmlpp_source_exp = xmlpp_exp
+        if xmlpp_profiler is not None: xmlpp_start = time.perf_counter()
+        xmlpp_parameterised = xmlpp_expression_cache.parameterise(xmlpp_exp) if xmlpp_has_context and not xmlpp_DEBUG else None
+        xmlpp_values = xmlpp_parameter_values(xmlpp_el, xmlpp_parameterised[0], xmlpp_attrib_name) if xmlpp_parameterised else None
+        if xmlpp_values is not None:
+            # Evaluate precompiled code with PARENT/SELF values as arguments, rather than compiling their substituted text:
+            for xmlpp_index, xmlpp_value in enumerate(xmlpp_values):
+                xmlpp_namespace[f'xmlpp_arg{xmlpp_index}'] = float(xmlpp_value) if '.' in xmlpp_value else int(xmlpp_value)
+            xmlpp_values.reverse()
+            xmlpp_exp = "".join([xmlpp_piece if isinstance(xmlpp_piece, str) else xmlpp_values.pop() for xmlpp_piece in xmlpp_parameterised[0]])
+            try:
+                xmlpp_result = xmlpp_result_cache.evaluate(xmlpp_source_exp, xmlpp_parameterised[1])
+            except Exception as e:
+                raise xmlpp_error(f"{type(e).__name__} evaluating {{{xmlpp_exp}}}: {sys.exception()}", xmlpp_el)
+        else:
+            if xmlpp_has_context: xmlpp_exp = xmlpp_eval_parent(xmlpp_el, xmlpp_exp, xmlpp_attrib_name)
             if xmlpp_exp == "":
                 xmlpp_result = ""
             else:
                 try:
-                    xmlpp_result = eval(xmlpp_exp)
+                    # With --low-memory, don't keep code for PARENT/SELF values substituted as text, which seldom recur:
+                    xmlpp_result = xmlpp_result_cache.evaluate(xmlpp_source_exp, xmlpp_expression_cache.compile(xmlpp_exp, not (xmlpp_LOW_MEMORY and xmlpp_has_context)))
                 except Exception as e:
                     raise xmlpp_error(f"{type(e).__name__} evaluating {{{xmlpp_exp}}}: {sys.exception()}", xmlpp_el)
-            if type(xmlpp_result) == type(xmlpp_root):  # string evaluates to an XML Element
-                if len(xmlpp_matches) != 3: raise xmlpp_error(f"evaluating \"{xmlpp_s}\": more than one {{expression}} in string when first {{expression}} returns XML.", xmlpp_el)
-                if xmlpp_matches[0] != "" or xmlpp_matches[2] != "": raise xmlpp_error(f"evaluating \"{xmlpp_s}\": an {{expression}} that returns XML must be the only content in the string.", xmlpp_el)
-                return xmlpp_result
-            if '{' in str(xmlpp_result): raise xmlpp_error(f"evaluated expression {xmlpp_exp} seems to contain another expression", xmlpp_el)
-            #print(exp,str(result))
-            xmlpp_matches[xmlpp_matchIndex] = '' if xmlpp_result is None else str(xmlpp_result)
-        xmlpp_matches = "".join(xmlpp_matches)
-        if xmlpp_DEBUG: print(f'      Result: <{xmlpp_el.tag} {xmlpp_attrib_name}="{xmlpp_matches}"', file=xmlpp_debug_file)
-        return xmlpp_matches
+        if xmlpp_profiler is not None:
+            xmlpp_profiler.add("{expression}", xmlpp_el, f"{{{xmlpp_source_exp}}}", time.perf_counter() - xmlpp_start)
+        if type(xmlpp_result) in (list, tuple) and xmlpp_result and all(type(xmlpp_item) == type(xmlpp_root) for xmlpp_item in xmlpp_result):
+            xmlpp_dummy_el = xmlpp_ET.Element("Dummy")  # so a list of sibling Elements is inserted like a <Dummy>'s children
+            xmlpp_dummy_el.extend(xmlpp_result)
+            xmlpp_result = xmlpp_dummy_el
+        if type(xmlpp_result) == type(xmlpp_root):  # string evaluates to an XML Element
+            if len(xmlpp_matches) != 3: raise xmlpp_error(f"evaluating \"{xmlpp_s}\": more than one {{expression}} in string when first {{expression}} returns XML.", xmlpp_el)
+            if xmlpp_matches[0] != "" or xmlpp_matches[2] != "": raise xmlpp_error(f"evaluating \"{xmlpp_s}\": an {{expression}} that returns XML must be the only content in the string.", xmlpp_el)
+            return xmlpp_result
+        if '{' in str(xmlpp_result): raise xmlpp_error(f"evaluated expression {xmlpp_exp} seems to contain another expression", xmlpp_el)
+        #print(exp,str(result))
+        xmlpp_matches[xmlpp_matchIndex] = '' if xmlpp_result is None else str(xmlpp_result)
+    xmlpp_matches = "".join(xmlpp_matches)
+    if xmlpp_DEBUG: print(f'      Result: <{xmlpp_el.tag} {xmlpp_attrib_name}="{xmlpp_matches}"', file=xmlpp_debug_file)
+    return xmlpp_matches
+
+def xmlpp_eval_element(xmlpp_el):
+    # Replaces {expression}s in the text, tail and attributes of xmlpp_el, which isn't a <Define>.
+    # Returns (number of elements inserted at start of xmlpp_el, number of elements inserted after xmlpp_el).
+
+    xmlpp_text_count = xmlpp_tail_count = 0
+    # Evaluate {expression}s in element's text:
+    if xmlpp_el.text:
+        xmlpp_text = xmlpp_el.text.strip()
+        if (xmlpp_text):
+            # print("   tag with text: "+xmlpp_el.tag)
+            xmlpp_processedText = xmlpp_evalStringWithExpressions(xmlpp_el, xmlpp_text)
+            if xmlpp_processedText is not False:    # replacement of original text is required
+                # print("\txmlpp_processedText=\""+xmlpp_processedText+"\"")
+                if isinstance(xmlpp_processedText, str):
+                    xmlpp_el.text = xmlpp_processedText
+                else:   # replace text with XML elements, or just delete text if None (eg, function call returning None):
+                    xmlpp_el.text = ""
+                    if xmlpp_processedText is not None:
+                        xmlpp_text_count = xmlpp_insert(xmlpp_el, 0, xmlpp_processedText)
+    # Evaluate {expression}s in element's tail:
+    if xmlpp_el.tail:
+        xmlpp_tail = xmlpp_el.tail.strip()
+        if (xmlpp_tail):
+            #print("   tag with tail: "+xmlpp_el.tag)
+            xmlpp_processedText = xmlpp_evalStringWithExpressions(xmlpp_el, xmlpp_tail) # may be string, XML or False
+            if xmlpp_processedText is not False:
+                if isinstance(xmlpp_processedText, str):
+                    #print("\txmlpp_processedText=\""+xmlpp_processedText+"\"")
+                    xmlpp_el.tail = xmlpp_processedText
+                else:   # insert XML elements
+                    xmlpp_el.tail = ""
+                    xmlpp_parent = xmlpp_el.getparent()
+                    xmlpp_index = list(xmlpp_parent).index(xmlpp_el) + 1
+                    xmlpp_tail_count = xmlpp_insert(xmlpp_parent, xmlpp_index, xmlpp_processedText) - xmlpp_index
+    # Evaluate {expression}s in element's attributes:
+    xmlpp_keys = xmlpp_el.keys()
+    # print("   keys=",xmlpp_keys)
+    for xmlpp_key in xmlpp_keys:
+        xmlpp_value = xmlpp_el.get(xmlpp_key)
+        xmlpp_processedValue = xmlpp_evalStringWithExpressions(xmlpp_el, xmlpp_value, xmlpp_key)
+        if xmlpp_processedValue != False:
+            #print(f"   {xmlpp_key}")
+            xmlpp_el.set(xmlpp_key, xmlpp_processedValue)
+    return xmlpp_text_count, xmlpp_tail_count
+
+def xmlpp_do_defines_and_expressions(): # execute <Define>s and replace all {expression}s with their results
+    xmlpp_phase_printer.print("processing <Define>s and {expression}s...")
 
     xmlpp_define_els = []   # <Define> elements to delete
     for xmlpp_el in xmlpp_root.iter():
         # print("tag="+xmlpp_el.tag)
         # If element is <Define>, execute its content:
         if xmlpp_el.tag == 'Define':
-            if (xmlpp_el.text): xmlpp_exec_definitions(xmlpp_el.text, xmlpp_el)
-            if (xmlpp_el.tail): xmlpp_exec_definitions(xmlpp_el.tail, xmlpp_el)       # TODO 3.9 is this sensible?
+            xmlpp_exec_define(xmlpp_el)
             xmlpp_define_els.append(xmlpp_el)
             continue
         # Element isn't <Define>, so...
-        # Evaluate {expression}s in element's text:
-        if xmlpp_el.text:
-            xmlpp_text = xmlpp_el.text.strip()
-            if (xmlpp_text):
-                # print("   tag with text: "+xmlpp_el.tag)
-                xmlpp_processedText = xmlpp_evalStringWithExpressions(xmlpp_el, xmlpp_text)
-                if xmlpp_processedText is not False:    # replacement of original text is required
-                    # print("\txmlpp_processedText=\""+xmlpp_processedText+"\"")
-                    if isinstance(xmlpp_processedText, str):
-                        xmlpp_el.text = xmlpp_processedText
-                    else:   # replace text with XML elements, or just delete text if None (eg, function call returning None):
-                        xmlpp_el.text = ""
-                        if xmlpp_processedText is not None:
-                            xmlpp_insert(xmlpp_el, 0, xmlpp_processedText)
-        # Evaluate {expression}s in element's tail:
-        if xmlpp_el.tail:
-            xmlpp_tail = xmlpp_el.tail.strip()
-            if (xmlpp_tail):
-                #print("   tag with tail: "+xmlpp_el.tag)
-                xmlpp_processedText = xmlpp_evalStringWithExpressions(xmlpp_el, xmlpp_tail) # may be string, XML or False
-                if xmlpp_processedText is not False:
-                    if isinstance(xmlpp_processedText, str):
-                        #print("\txmlpp_processedText=\""+xmlpp_processedText+"\"")
-                        xmlpp_el.tail = xmlpp_processedText
-                    else:   # insert XML elements
-                        xmlpp_el.tail = ""
-                        xmlpp_parent = xmlpp_el.getparent()
-                        xmlpp_index = list(xmlpp_parent).index(xmlpp_el) + 1
-                        xmlpp_insert(xmlpp_parent, xmlpp_index, xmlpp_processedText)
-        # Evaluate {expression}s in element's attributes:
-        xmlpp_keys = xmlpp_el.keys()
-        # print("   keys=",xmlpp_keys)
-        for xmlpp_key in xmlpp_keys:
-            xmlpp_value = xmlpp_el.get(xmlpp_key)
-            xmlpp_processedValue = xmlpp_evalStringWithExpressions(xmlpp_el, xmlpp_value, xmlpp_key)
-            if xmlpp_processedValue != False:
-                #print(f"   {xmlpp_key}")
-                xmlpp_el.set(xmlpp_key, xmlpp_processedValue)
+        xmlpp_eval_element(xmlpp_el)
     # Delete all <Define> elements:
     for xmlpp_el in xmlpp_define_els:
         xmlpp_parent = xmlpp_el.getparent()
         if xmlpp_parent is None: raise xmlpp_error("Can't remove a <Define> because it is the root element", xmlpp_el)
         xmlpp_parent.remove(xmlpp_el)
+    if xmlpp_DEBUG: xmlpp_expression_cache.print_stats()
+
+def xmlpp_apply_if(xmlpp_el, xmlpp_if_el):
+    # Replaces <If> element xmlpp_if_el, which is a child of xmlpp_el, with its children if its condition is 'True',
+    # or deletes it otherwise.
+    if "condition" not in xmlpp_if_el.attrib: raise xmlpp_error("<If> missing 'condition' attribute.", xmlpp_if_el)
+    xmlpp_condition = xmlpp_if_el.attrib["condition"]
+    if (xmlpp_DEBUG): print(f'   Considering <If condition="{xmlpp_condition}">', file=xmlpp_debug_file)
+    if xmlpp_condition == 'True':
+        # Move the children (with their tails), rather than copying them, because the <If> is discarded anyway:
+        for xmlpp_if_child_el in list(xmlpp_if_el):
+            xmlpp_if_el.addprevious(xmlpp_if_child_el)
+        xmlpp_el.remove(xmlpp_if_el) # remove the <If> itself
+    else:       # xmlpp_condition != 'True'
+        xmlpp_el.remove(xmlpp_if_el)   # delete this <If>
 
 def xmlpp_process_all_ifs():  # process all <If> elements
     xmlpp_phase_printer.print("applying <If> elements...")
@@ -481,39 +1471,309 @@ def xmlpp_process_all_ifs():  # process all <If> elements
             xmlpp_child_el = xmlpp_el[xmlpp_index]
             # print(xmlpp_child_el.tag)
             if xmlpp_child_el.tag == "If":
-                if "condition" not in xmlpp_child_el.attrib: xmlpp_error("<If> missing 'condition' attribute.")
-                xmlpp_condition = xmlpp_child_el.attrib["condition"]
-                if (xmlpp_DEBUG): print(f'   Considering <If condition="{xmlpp_condition}">', file=xmlpp_debug_file)
-                if xmlpp_condition == 'True':
-                    xmlpp_if_els = []
-                    for xmlpp_if_el in xmlpp_child_el:  # make deep copy of each xmlpp_child_el because lxml wants each el to have its own parent
-                        xmlpp_if_els.append(copy.deepcopy(xmlpp_if_el))
-                    xmlpp_el.remove(xmlpp_child_el) # remove the <If> itself
-                    # Insert xmlpp_if_els:
-                    xmlpp_if_index = xmlpp_index
-                    for xmlpp_if_el in xmlpp_if_els:
-                        #print(f"inserting content at {xmlpp_index}")
-                        xmlpp_el.insert(xmlpp_if_index, xmlpp_if_el)
-                        xmlpp_if_index += 1
-                else:       # xmlpp_condition != 'True'
-                    xmlpp_el.remove(xmlpp_child_el)   # delete this <If>
+                xmlpp_apply_if(xmlpp_el, xmlpp_child_el)   # don't advance xmlpp_index: retained children may contain <If>s
             else:   # xmlpp_child_el is not <If>
                 xmlpp_process_ifs(xmlpp_child_el)    # recurse
                 xmlpp_index += 1
 
     xmlpp_process_ifs(xmlpp_root)
 
+def xmlpp_remove_data_attribs(xmlpp_el):
+    # Removes data- attributes from xmlpp_el (but not its children).
+    for xmlpp_attrib_name in xmlpp_el.keys():
+        if xmlpp_attrib_name.startswith("data-"):
+            xmlpp_el.attrib.pop(xmlpp_attrib_name, None)
+
 def xmlpp_remove_data_attributes():
     xmlpp_phase_printer.print("removing data- attributes")
     for xmlpp_el in xmlpp_root.iter():
-        for xmlpp_attrib_name in xmlpp_el.keys():
-            if xmlpp_attrib_name.startswith("data-"):
-                xmlpp_el.attrib.pop(xmlpp_attrib_name, None)
+        xmlpp_remove_data_attribs(xmlpp_el)
+
+XMLPP_PARALLEL_MIN_ELEMENTS = 1000     # --parallel doesn't fork workers for runs of subtrees with fewer elements than this
+xmlpp_RANGE_REGEXP = re.compile(r'\s*range\(\s*(-?\d+)\s*(?:,\s*(-?\d+)\s*)?(?:,\s*(-?\d+)\s*)?\)\s*')    # eg, 'range(1, 10)'
 
-def xmlpp_write_dest(xmlpp_dest_file):
-    xmlpp_phase_printer.print("writing {xmlpp_dest_file}...")
-    xmlpp_tree.write(xmlpp_dest_file)
-    if xmlpp_DEBUG: print(f"\nFinished: no preprocessor errors found.", file=xmlpp_debug_file)
+def xmlpp_repeat_iterations(xmlpp_repeat_el):
+    # Returns the number of iterations of <Repeat> xmlpp_repeat_el if that's evident from its 'in' attribute (a range()
+    # of literal numbers, or a literal list or tuple); otherwise 1. Used to estimate how big a subtree will become.
+    xmlpp_in = xmlpp_repeat_el.get('in', '')
+    xmlpp_match = xmlpp_RANGE_REGEXP.fullmatch(xmlpp_in)
+    if xmlpp_match:
+        try:
+            return len(range(*(int(xmlpp_group) for xmlpp_group in xmlpp_match.groups() if xmlpp_group is not None)))
+        except ValueError:  # eg, a step of 0
+            return 1
+    if xmlpp_in.strip()[:1] in ('[', '('):
+        import ast
+        try:
+            xmlpp_values = ast.literal_eval(xmlpp_in.strip())
+            if type(xmlpp_values) in (list, tuple): return len(xmlpp_values)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            pass
+    return 1
+xmlpp_parallel_work = None  # (function, parent, children, following elements) for --parallel workers, which inherit it when forked
+
+def xmlpp_can_fork():
+    # Returns True if --parallel workers can be forked (not on Windows); otherwise children are processed serially.
+    import multiprocessing
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+def xmlpp_parallel_task(xmlpp_index):
+    # Runs in a --parallel worker process: processes the xmlpp_index'th child in xmlpp_parallel_work.
+    xmlpp_function, xmlpp_el, xmlpp_run_els, xmlpp_stop_els = xmlpp_parallel_work
+    return xmlpp_function(xmlpp_el, xmlpp_run_els[xmlpp_index], xmlpp_stop_els[xmlpp_index])
+
+def xmlpp_process_all_elements():   # fused equivalent of xmlpp_expand_all_repeats(), xmlpp_do_defines_and_expressions(), xmlpp_process_all_ifs() and xmlpp_remove_data_attributes()
+    xmlpp_phase_printer.print("processing <Repeat>s, <Define>s, {expression}s, <If>s and data- attributes")
+
+    global xmlpp_inherited_attribs, xmlpp_stream_writer
+
+    def xmlpp_process(xmlpp_el, xmlpp_evaluate):
+        # Processes xmlpp_el and its subtree in a single depth-first walk: <If>s are applied, and data- attributes removed,
+        # as soon as their subtree is complete. If xmlpp_evaluate is False, <Repeat>s, <Define>s and {expression}s are left alone.
+        # Returns number of elements inserted after xmlpp_el by its tail, which must be processed with xmlpp_evaluate False.
+        xmlpp_text_count = xmlpp_tail_count = 0
+        xmlpp_streaming = xmlpp_stream_writer is not None and xmlpp_stream_writer.is_container(xmlpp_el)
+        if xmlpp_evaluate:
+            if xmlpp_el.tag == 'Define':
+                xmlpp_exec_define(xmlpp_el)
+                xmlpp_inherited_attribs.invalidate()    # <Define> code could have changed the tree
+            else:
+                xmlpp_had_children = len(xmlpp_el) > 0
+                xmlpp_text_count, xmlpp_tail_count = xmlpp_eval_element(xmlpp_el)
+                # Functions that return XML could also have changed the tree:
+                if xmlpp_text_count or xmlpp_tail_count: xmlpp_inherited_attribs.invalidate()
+                # The phased walk (xmlpp_root.iter()) has already chosen the next element before xmlpp_el is processed,
+                # so XML inserted by an {expression} is only evaluated if it follows (in the tail of) an element with children:
+                if xmlpp_had_children: xmlpp_tail_count = 0
+            xmlpp_inherited_attribs.push(xmlpp_el)
+
+        if xmlpp_streaming: xmlpp_stream_writer.open(xmlpp_el)
+        xmlpp_first_el = xmlpp_el[0] if len(xmlpp_el) else None
+        if xmlpp_PARALLEL and xmlpp_evaluate and xmlpp_el.getparent() is xmlpp_root and xmlpp_can_fork():
+            xmlpp_process_children_in_parallel(xmlpp_el, xmlpp_first_el, xmlpp_text_count)
+        else:
+            xmlpp_process_children(xmlpp_el, xmlpp_first_el, None, xmlpp_text_count, xmlpp_evaluate)
+        if xmlpp_evaluate: xmlpp_inherited_attribs.pop()
+        xmlpp_remove_data_attribs(xmlpp_el)
+        if xmlpp_streaming: xmlpp_stream_writer.close(xmlpp_el)
+        return xmlpp_tail_count
+
+    def xmlpp_process_children(xmlpp_el, xmlpp_child_el, xmlpp_stop_el, xmlpp_unevaluated_count, xmlpp_evaluate):
+        # Processes children of xmlpp_el from xmlpp_child_el up to (but excluding) xmlpp_stop_el, or to the end if it's None.
+        # xmlpp_unevaluated_count is the number of children from xmlpp_child_el that mustn't be evaluated.
+        # Steps from one child to the next with getnext(), because lxml's len() and [] take time proportional to the
+        # number of children, and there can be a great many of them (eg, after lots of <Use>s or <Repeat> iterations).
+        xmlpp_flush = xmlpp_stream_writer is not None and xmlpp_stream_writer.is_open(xmlpp_el)
+        while xmlpp_child_el is not None and xmlpp_child_el is not xmlpp_stop_el:
+            if xmlpp_flush: xmlpp_stream_writer.flush(xmlpp_el, xmlpp_child_el)   # everything before xmlpp_child_el is finished
+            xmlpp_child_evaluate = xmlpp_evaluate and xmlpp_unevaluated_count == 0
+            if xmlpp_child_el.tag == 'Repeat' and xmlpp_child_evaluate:
+                xmlpp_child_el = xmlpp_process_repeat(xmlpp_el, xmlpp_child_el)
+                continue
+            if xmlpp_child_el.tag == 'Use' and xmlpp_deferred_uses is not None and xmlpp_child_el in xmlpp_deferred_uses:
+                xmlpp_deferred_uses.discard(xmlpp_child_el)
+                xmlpp_child_el = xmlpp_replace_use(xmlpp_el, xmlpp_child_el)
+                continue
+            if xmlpp_unevaluated_count: xmlpp_unevaluated_count -= 1
+            xmlpp_unevaluated_count += xmlpp_process(xmlpp_child_el, xmlpp_child_evaluate)
+            xmlpp_next_el = xmlpp_child_el.getnext()
+            if xmlpp_child_el.tag == 'Define' and xmlpp_child_evaluate:
+                xmlpp_el.remove(xmlpp_child_el)
+            elif xmlpp_child_el.tag == 'If':
+                xmlpp_apply_if(xmlpp_el, xmlpp_child_el)     # retained children have already been processed
+            xmlpp_child_el = xmlpp_next_el
+        if xmlpp_flush: xmlpp_stream_writer.flush(xmlpp_el, xmlpp_stop_el)
+
+    def xmlpp_process_children_in_parallel(xmlpp_el, xmlpp_child_el, xmlpp_unevaluated_count):
+        # Equivalent of xmlpp_process_children(xmlpp_el, xmlpp_child_el, None, xmlpp_unevaluated_count, True) for --parallel.
+        # Runs of consecutive children that don't contain a <Define> are independent of each other: their {expression}s
+        # can only read the namespace, and PARENT only reads ancestors, which are already finished. So each run is
+        # processed by worker processes forked after everything before it is finished, and their results are put into the
+        # tree in document order. Children containing <Define>s, and runs too small to be worth it, are processed here.
+        # A child containing a <Repeat> ends its run, because the loop variable stays defined afterwards, and workers'
+        # changes to the namespace are only merged once the whole run is finished.
+        if xmlpp_unevaluated_count:     # XML inserted into xmlpp_el's text by an {expression} isn't evaluated
+            xmlpp_stop_el = xmlpp_child_el
+            for _ in range(xmlpp_unevaluated_count): xmlpp_stop_el = xmlpp_stop_el.getnext()
+            xmlpp_process_children(xmlpp_el, xmlpp_child_el, xmlpp_stop_el, xmlpp_unevaluated_count, True)
+            xmlpp_child_el = xmlpp_stop_el
+        while xmlpp_child_el is not None:
+            xmlpp_run_els, xmlpp_size = [], 0
+            xmlpp_next_el = xmlpp_child_el
+            while xmlpp_next_el is not None:
+                xmlpp_independent = xmlpp_independent_size(xmlpp_next_el)
+                if xmlpp_independent is None: break
+                xmlpp_run_els.append(xmlpp_next_el)
+                xmlpp_size += xmlpp_independent[0]
+                xmlpp_next_el = xmlpp_next_el.getnext()
+                if xmlpp_independent[1]: break  # later children could read its <Repeat>'s loop variable
+            if len(xmlpp_run_els) > 1 and xmlpp_size >= XMLPP_PARALLEL_MIN_ELEMENTS:
+                xmlpp_process_run_in_workers(xmlpp_el, xmlpp_run_els, xmlpp_next_el)
+            else:
+                if not xmlpp_run_els: xmlpp_next_el = xmlpp_child_el.getnext()     # eg, a <Define>: process it on its own
+                xmlpp_process_children(xmlpp_el, xmlpp_child_el, xmlpp_next_el, 0, True)
+            xmlpp_child_el = xmlpp_next_el
+
+    def xmlpp_independent_size(xmlpp_el):
+        # Returns (estimated number of elements in xmlpp_el's subtree once <Repeat>s are expanded, True if it contains
+        # a <Repeat>), or None if it contains a <Define>.
+        if xmlpp_el.tag == 'Define': return None
+        xmlpp_count, xmlpp_has_repeat = 1, xmlpp_el.tag == 'Repeat'
+        for xmlpp_sub_el in xmlpp_el:
+            xmlpp_independent = xmlpp_independent_size(xmlpp_sub_el)
+            if xmlpp_independent is None: return None
+            xmlpp_count += xmlpp_independent[0]
+            xmlpp_has_repeat |= xmlpp_independent[1]
+        if xmlpp_el.tag == 'Repeat': xmlpp_count = 1 + (xmlpp_count - 1) * xmlpp_repeat_iterations(xmlpp_el)
+        return xmlpp_count, xmlpp_has_repeat
+
+    def xmlpp_process_run_in_workers(xmlpp_el, xmlpp_run_els, xmlpp_following_el):
+        # Processes xmlpp_run_els, which are consecutive independent children of xmlpp_el, in worker processes.
+        # Workers are forked here, so they start with the current tree and namespace.
+        global xmlpp_parallel_work
+        import multiprocessing
+        import pickle
+        from concurrent.futures import ProcessPoolExecutor
+        xmlpp_stop_els = xmlpp_run_els[1:] + [xmlpp_following_el]
+        xmlpp_parallel_work = (xmlpp_process_in_worker, xmlpp_el, xmlpp_run_els, xmlpp_stop_els)
+        xmlpp_workers = min(xmlpp_JOBS or os.cpu_count() or 1, len(xmlpp_run_els))
+        try:
+            with ProcessPoolExecutor(max_workers=xmlpp_workers, mp_context=multiprocessing.get_context('fork')) as xmlpp_executor:
+                xmlpp_results = list(xmlpp_executor.map(xmlpp_parallel_task, range(len(xmlpp_run_els)),
+                                                        chunksize=max(1, len(xmlpp_run_els) // (xmlpp_workers * 4))))
+        finally:
+            xmlpp_parallel_work = None
+        for xmlpp_member_el, xmlpp_stop_el, xmlpp_result in zip(xmlpp_run_els, xmlpp_stop_els, xmlpp_results):
+            if xmlpp_result is None:    # the worker couldn't do it (eg, because of an error, which will now be reported)
+                xmlpp_process_children(xmlpp_el, xmlpp_member_el, xmlpp_stop_el, 0, True)
+                continue
+            xmlpp_xml, xmlpp_defined = xmlpp_result
+            for xmlpp_new_el in list(xmlpp_ET.fromstring(xmlpp_xml)):
+                xmlpp_member_el.addprevious(xmlpp_new_el)
+            xmlpp_el.remove(xmlpp_member_el)
+            xmlpp_namespace.update(pickle.loads(xmlpp_defined))    # eg, <Repeat> loop variables
+
+    def xmlpp_process_in_worker(xmlpp_el, xmlpp_member_el, xmlpp_stop_el):
+        # Runs in a --parallel worker process: processes xmlpp_member_el, a child of xmlpp_el, as xmlpp_process_children() would.
+        # Returns (serialised <Dummy> containing whatever xmlpp_member_el has become, pickled {name: value} of every symbol
+        # assigned in the namespace), or None if xmlpp_member_el should be processed by the main process instead.
+        import pickle
+        xmlpp_previous_el = xmlpp_member_el.getprevious()
+        xmlpp_symbols_before = dict(xmlpp_namespace)
+        try:
+            xmlpp_process_children(xmlpp_el, xmlpp_member_el, xmlpp_stop_el, 0, True)
+        except xmlpp_error:
+            return None
+        xmlpp_unset = object()
+        xmlpp_defined = {xmlpp_name: xmlpp_value for xmlpp_name, xmlpp_value in xmlpp_namespace.items()
+                         if xmlpp_symbols_before.get(xmlpp_name, xmlpp_unset) is not xmlpp_value}
+        try:
+            xmlpp_defined = pickle.dumps(xmlpp_defined)
+        except Exception:   # eg, a loop variable whose value can't be sent to the main process
+            return None
+        xmlpp_dummy_el = xmlpp_ET.Element("Dummy")
+        xmlpp_region_el = next(iter(xmlpp_el), None) if xmlpp_previous_el is None else xmlpp_previous_el.getnext()
+        while xmlpp_region_el is not None and xmlpp_region_el is not xmlpp_stop_el:
+            xmlpp_next_el = xmlpp_region_el.getnext()
+            xmlpp_dummy_el.append(xmlpp_region_el)
+            xmlpp_region_el = xmlpp_next_el
+        return xmlpp_ET.tostring(xmlpp_dummy_el), xmlpp_defined
+
+    def xmlpp_process_repeat(xmlpp_el, xmlpp_repeat_el):
+        # Replaces <Repeat> element xmlpp_repeat_el, which is a child of xmlpp_el, with a processed copy of its children
+        # for every iteration. The loop variable is assigned directly, rather than via a <Define>, and each copy is
+        # processed before the next is made, so the loop variable has the right value for every {expression},
+        # <Define> and nested <Repeat> in it.
+        # Returns element after the last copy (None if there isn't one).
+        if "for" not in xmlpp_repeat_el.attrib: raise xmlpp_error("<Repeat> missing 'for' attribute.", xmlpp_repeat_el)
+        xmlpp_for = xmlpp_repeat_el.attrib["for"]
+        if "in" not in xmlpp_repeat_el.attrib: raise xmlpp_error("<Repeat> missing 'in' attribute.", xmlpp_repeat_el)
+        xmlpp_in = xmlpp_repeat_el.attrib["in"]
+        if (xmlpp_DEBUG): print(f'   Expanding <Repeat for="{xmlpp_for}" in="{xmlpp_in}">', file=xmlpp_debug_file)
+        xmlpp_following_el = xmlpp_repeat_el.getnext()
+        xmlpp_el.remove(xmlpp_repeat_el)     # remove the <Repeat> element itself; its children are copied from it below
+        try:
+            xmlpp_values = eval(xmlpp_expression_cache.compile(xmlpp_in), xmlpp_namespace)
+            xmlpp_check_strict(f"{xmlpp_for} = None", 'exec')
+            # A simple loop variable can be stored directly; anything else (eg, "x, y") is assigned by compiled code:
+            xmlpp_assignment = None if xmlpp_for.isidentifier() else compile(f"{xmlpp_for} = xmlpp_repeat_value", "<Repeat>", "exec")
+        except Exception as e:
+            raise xmlpp_error(f"{type(e).__name__} evaluating <Repeat for=\"{xmlpp_for}\" in=\"{xmlpp_in}\">: {sys.exception()}", xmlpp_repeat_el)
+        # When the last iteration is known, it can have xmlpp_repeat_el's children rather than copies. A list could be
+        # lengthened by code in the loop, so that's only assumed not to happen with --low-memory:
+        xmlpp_sized = type(xmlpp_values) in (range, tuple) or (xmlpp_LOW_MEMORY and type(xmlpp_values) is list)
+        for xmlpp_iteration, xmlpp_value in enumerate(xmlpp_values):
+            if xmlpp_DEBUG: print(f'      {xmlpp_for} = {xmlpp_value!r}', file=xmlpp_debug_file)
+            if xmlpp_assignment is None:
+                xmlpp_namespace[xmlpp_for] = xmlpp_value
+            else:
+                xmlpp_namespace["xmlpp_repeat_value"] = xmlpp_value
+                try:
+                    exec(xmlpp_assignment, xmlpp_namespace)
+                except Exception as e:
+                    raise xmlpp_error(f"{type(e).__name__} assigning <Repeat for=\"{xmlpp_for}\">: {sys.exception()}", xmlpp_repeat_el)
+            xmlpp_first_el = None
+            xmlpp_last = xmlpp_sized and xmlpp_iteration == len(xmlpp_values) - 1
+            for xmlpp_repeat_child_el in list(xmlpp_repeat_el) if xmlpp_last else xmlpp_repeat_el:
+                # deepcopy because lxml el can only have one parent:
+                xmlpp_copy_el = xmlpp_repeat_child_el if xmlpp_last else copy.deepcopy(xmlpp_repeat_child_el)
+                if xmlpp_following_el is None: xmlpp_el.append(xmlpp_copy_el)
+                else: xmlpp_following_el.addprevious(xmlpp_copy_el)
+                if xmlpp_first_el is None: xmlpp_first_el = xmlpp_copy_el
+            xmlpp_process_children(xmlpp_el, xmlpp_first_el, xmlpp_following_el, 0, True)
+        return xmlpp_following_el
+
+    if xmlpp_stream_writer is not None:
+        if xmlpp_stream_writer.can_stream(xmlpp_tree): xmlpp_stream_writer.start()
+        else: xmlpp_stream_writer = None    # output will be written after processing instead
+    xmlpp_inherited_attribs = xmlpp_InheritedAttribs()
+    xmlpp_process(xmlpp_root, True)
+    xmlpp_inherited_attribs = None
+    if xmlpp_root.tag == 'Define': raise xmlpp_error("Can't remove a <Define> because it is the root element", xmlpp_root)
+    if xmlpp_DEBUG: xmlpp_expression_cache.print_stats()
+
+def xmlpp_open_temp(xmlpp_dest):
+    # Returns (binary file, path) of a new temporary file in the same folder as xmlpp_dest.
+    import tempfile
+    xmlpp_fd, xmlpp_path = tempfile.mkstemp(prefix=os.path.basename(xmlpp_dest) + '.', suffix='.tmp',
+                                            dir=os.path.dirname(os.path.abspath(xmlpp_dest)))
+    return os.fdopen(xmlpp_fd, 'wb'), xmlpp_path
+
+def xmlpp_replace_file(xmlpp_temp_path, xmlpp_dest):
+    # Renames xmlpp_temp_path to xmlpp_dest, unless xmlpp_dest already has the same content (in which case it isn't
+    # touched, so its modification time doesn't trigger unnecessary rebuilds). Returns True if xmlpp_dest was changed.
+    import filecmp
+    if os.path.isfile(xmlpp_dest) and filecmp.cmp(xmlpp_temp_path, xmlpp_dest, shallow=False):
+        os.remove(xmlpp_temp_path)
+        return False
+    if os.path.exists(xmlpp_dest):
+        xmlpp_mode = os.stat(xmlpp_dest).st_mode & 0o7777
+    else:   # mkstemp() makes files that only the owner can read, so give it normal permissions
+        xmlpp_umask = os.umask(0)
+        os.umask(xmlpp_umask)
+        xmlpp_mode = 0o666 & ~xmlpp_umask
+    os.chmod(xmlpp_temp_path, xmlpp_mode)
+    os.replace(xmlpp_temp_path, xmlpp_dest)
+    return True
+
+def xmlpp_write_dest(xmlpp_dest_file, xmlpp_temp_path=None):
+    # Writes xmlpp_tree to xmlpp_dest_file or, if xmlpp_temp_path, uses the output already written there by
+    # xmlpp_StreamWriter. The output is written to a temporary file and then renamed, so xmlpp_dest_file is never
+    # left half-written. Returns True if xmlpp_dest_file was changed.
+    xmlpp_phase_printer.print(f"writing {xmlpp_dest_file}")
+    if xmlpp_temp_path is None:
+        if xmlpp_PRETTY is not None: xmlpp_ET.indent(xmlpp_tree, xmlpp_PRETTY)
+        xmlpp_file, xmlpp_temp_path = xmlpp_open_temp(xmlpp_dest_file)
+        try:
+            with xmlpp_file: xmlpp_tree.write(xmlpp_file)
+        except BaseException:
+            os.remove(xmlpp_temp_path)
+            raise
+    xmlpp_changed = xmlpp_replace_file(xmlpp_temp_path, xmlpp_dest_file)
+    if xmlpp_DEBUG:
+        if not xmlpp_changed: print(f"   {xmlpp_dest_file} already had this content, so it wasn't rewritten.", file=xmlpp_debug_file)
+        print(f"\nFinished: no preprocessor errors found.", file=xmlpp_debug_file)
+    return xmlpp_changed
 
 def pp_log(xmlpp_arg, xmlpp_prompt="pp_log arg:"):
     # Console logging function callable from watchface-pp.xml functions and {expression}s.
@@ -523,15 +1783,321 @@ def pp_log(xmlpp_arg, xmlpp_prompt="pp_log arg:"):
     print(f"{xmlpp_prompt} value is '{xmlpp_arg}'; type is {type(xmlpp_arg)}")
     return xmlpp_arg
 
-xmlpp_parse_args()
-xmlpp_tree = xmlpp_load_source(xmlpp_source_file)
-xmlpp_root = xmlpp_tree.getroot()
-xmlpp_extract_symbols()
-xmlpp_replace_all_uses()
-xmlpp_expand_all_repeats()
-xmlpp_do_defines_and_expressions()
-xmlpp_process_all_ifs()
-xmlpp_remove_data_attributes()
-xmlpp_write_dest(xmlpp_dest_file)
-
-if xmlpp_DEBUG: xmlpp_debug_file.close()
\ No newline at end of file
+def pp_emit(xmlpp_tag, _into=None, _children=None, **xmlpp_columns):
+    # Element generation function callable from watchface-pp.xml functions and {expression}s.
+    # Creates a sequence of xmlpp_tag elements in one go, taking their attribute values from xmlpp_columns; eg,
+    # pp_emit("Line", startX=xs, startY=ys, endX=225, endY=225) makes one <Line> for every value in xs and ys.
+    #    xmlpp_tag: tag of every element
+    #    _into: optional Element to append the new elements to; by default, they're children of a new <Dummy>
+    #    _children: optional Element (or list of Elements) to copy into every new element
+    #    xmlpp_columns: attribute values. Sequences (lists, tuples, ranges, NumPy arrays, etc) must all have the same
+    #       length, which is the number of elements created; anything else is used for every element. Use
+    #       **{"data-x": ...} for attribute names that aren't valid Python names.
+    # Returns _into, or the <Dummy>, which can be returned from an {expression} to insert the new elements.
+    xmlpp_parent = xmlpp_ET.Element("Dummy") if _into is None else _into
+    xmlpp_names = list(xmlpp_columns)
+    xmlpp_count = None
+    for xmlpp_value in xmlpp_columns.values():
+        if isinstance(xmlpp_value, str) or not hasattr(xmlpp_value, '__len__'): continue
+        if xmlpp_count is not None and len(xmlpp_value) != xmlpp_count:
+            raise ValueError(f"pp_emit(\"{xmlpp_tag}\"...): attribute value sequences must all have the same length")
+        xmlpp_count = len(xmlpp_value)
+    if xmlpp_count is None: xmlpp_count = 1     # nothing but single values: make one element
+    # Convert each column to strings in one go, and then make the elements row by row:
+    xmlpp_string_columns = []
+    for xmlpp_value in xmlpp_columns.values():
+        if isinstance(xmlpp_value, str) or not hasattr(xmlpp_value, '__len__'):
+            xmlpp_string_columns.append([str(xmlpp_value)] * xmlpp_count)
+        else:
+            xmlpp_string_columns.append(list(map(str, xmlpp_value)))
+    if _children is not None and type(_children) not in (list, tuple): _children = [_children]
+    for xmlpp_row in zip(*xmlpp_string_columns) if xmlpp_names else [()] * xmlpp_count:
+        xmlpp_el = xmlpp_ET.SubElement(xmlpp_parent, xmlpp_tag, dict(zip(xmlpp_names, xmlpp_row)))
+        if _children is not None:
+            for xmlpp_child_el in _children: xmlpp_el.append(copy.deepcopy(xmlpp_child_el))
+    return xmlpp_parent
+
+def xmlpp_run():
+    # Processes xmlpp_source_file and writes xmlpp_dest_file. Returns False if there was nothing to do.
+    # Raises xmlpp_error if processing fails.
+    global xmlpp_debug_file, xmlpp_OVERWRITE, xmlpp_profiler, xmlpp_stream_writer
+
+    if xmlpp_DEBUG:
+        xmlpp_debug_file = open('debug-pp.txt', 'w')
+        print(xmlpp_VERSION, file=xmlpp_debug_file)
+
+    if xmlpp_INCREMENTAL and xmlpp_is_up_to_date(xmlpp_source_file, xmlpp_dest_file):
+        print(f"{xmlpp_dest_file} is up to date.")
+        if xmlpp_DEBUG:
+            print(f"\n{xmlpp_dest_file} is up to date; nothing to do.", file=xmlpp_debug_file)
+            xmlpp_debug_file.close()
+        return False
+
+    if os.path.exists(xmlpp_dest_file) and not xmlpp_OVERWRITE:
+        xmlpp_overwrite_input = input("Destination file already exists; overwrite it (y/n)? ")
+        if (xmlpp_overwrite_input != "y"): exit(2)
+        xmlpp_OVERWRITE = True      # don't ask again in --watch mode
+
+    xmlpp_import_lxml()
+    xmlpp_profiler = xmlpp_Profiler() if xmlpp_PROFILE else None
+    xmlpp_temp_path = None
+    if xmlpp_STREAM:
+        xmlpp_writer = xmlpp_stream_writer = xmlpp_StreamWriter(xmlpp_dest_file, xmlpp_PRETTY)
+        try:
+            xmlpp_process(xmlpp_source_file)
+            xmlpp_temp_path = xmlpp_writer.finish()     # None if the tree couldn't be streamed, so write it in the usual way
+        except BaseException:
+            xmlpp_writer.abort()
+            raise
+        finally:
+            xmlpp_stream_writer = None
+    else:
+        xmlpp_process(xmlpp_source_file)
+    xmlpp_write_dest(xmlpp_dest_file, xmlpp_temp_path)
+    if xmlpp_INCREMENTAL: xmlpp_write_manifest(xmlpp_source_file, xmlpp_dest_file)
+    if xmlpp_profiler is not None:
+        xmlpp_profiler.report('profile-pp.json')
+        xmlpp_profiler = None
+
+    if xmlpp_DEBUG: xmlpp_debug_file.close()
+    return True
+
+def xmlpp_process(xmlpp_source):
+    # Loads xmlpp_source and processes it, using current options. Returns the resulting tree.
+    # Raises xmlpp_error if processing fails.
+    global xmlpp_tree, xmlpp_root, xmlpp_symbols, xmlpp_dependencies, xmlpp_namespace, xmlpp_phase_printer, xmlpp_deferred_uses
+
+    xmlpp_import_lxml()
+    # Start from scratch, so nothing is left over from a previous run:
+    xmlpp_tree = xmlpp_root = None
+    xmlpp_symbols = {}
+    xmlpp_symbol_expansion.clear()
+    xmlpp_dependencies = {}
+    xmlpp_phase_printer = xmlpp_PhasePrinter()
+
+    xmlpp_code_cache.load(xmlpp_source)
+    xmlpp_result_cache.load(xmlpp_source)
+    xmlpp_tree = xmlpp_load_source(xmlpp_source)
+    xmlpp_root = xmlpp_tree.getroot()
+    # A fresh namespace, so <Define>s can't affect the preprocessor or subsequent runs:
+    xmlpp_namespace = xmlpp_strict_namespace() if xmlpp_STRICT else dict(globals())
+    xmlpp_namespace.update(xmlpp_variables)
+    xmlpp_extract_symbols()
+    if xmlpp_PHASED:
+        xmlpp_replace_all_uses()
+        xmlpp_expand_all_repeats()
+        xmlpp_do_defines_and_expressions()
+        xmlpp_process_all_ifs()
+        xmlpp_remove_data_attributes()
+    else:
+        if xmlpp_LOW_MEMORY and xmlpp_stream_writer is not None and xmlpp_stream_writer.can_stream(xmlpp_tree):
+            xmlpp_deferred_uses = set()
+        try:
+            xmlpp_replace_all_uses()
+            xmlpp_process_all_elements()
+        finally:
+            xmlpp_deferred_uses = None
+    xmlpp_code_cache.save()
+    xmlpp_result_cache.save()
+    if xmlpp_DEBUG: xmlpp_code_cache.print_stats()
+    return xmlpp_tree
+
+class Preprocessor:
+    """ Processes source files from other Python code, without running preprocess.py as a script; eg:
+            from preprocess import Preprocessor, PreprocessorError
+            xmlpp = Preprocessor(variables={"COLOUR": "#FF0000"})
+            xmlpp.process("watchface-pp.xml", "watchface.xml")
+        process() raises PreprocessorError (with message and sourceline attributes) rather than exiting.
+        A Preprocessor can be reused: imported files and {expression}s that were seen before aren't parsed again.
+        Every call to process() gets a fresh namespace for <Define> code and {expression}s, containing variables.
+        Processing uses module-level state, so don't call process() from more than one thread at a time. """
+
+    def __init__(self, phased=False, debug=False, pretty=False, variables=None, parallel=False, strict=False):
+        self.phased = phased        # True to walk the tree once per phase (see --phased)
+        self.strict = strict        # True to restrict what Python code in sources can do (see --strict)
+        self.parallel = parallel    # True to evaluate independent subtrees in worker processes (see --parallel)
+        self.pretty = pretty        # True to indent the file written by process() (see --pretty)
+        self.debug = debug          # True to write debug-pp.txt (see -d)
+        self.variables = {} if variables is None else variables     # predefined symbols: {name: value} (values aren't evaluated)
+        self.dependencies = []      # paths of files read by the most recent call to process()
+
+    def process(self, source, dest=None):
+        # Returns the processed tree (use lxml.etree.tostring() to get bytes). Writes it to dest too, if provided.
+        global xmlpp_DEBUG, xmlpp_PHASED, xmlpp_INCREMENTAL, xmlpp_VERBOSE, xmlpp_PRETTY, xmlpp_PARALLEL, xmlpp_STRICT, xmlpp_variables, xmlpp_debug_file
+        xmlpp_DEBUG, xmlpp_PHASED, xmlpp_INCREMENTAL, xmlpp_VERBOSE, xmlpp_variables = self.debug, self.phased, False, False, self.variables
+        xmlpp_PARALLEL = self.parallel and not (self.debug or self.phased)
+        xmlpp_PRETTY = "    " if self.pretty else None
+        xmlpp_STRICT = self.strict
+        if not os.path.exists(source): raise xmlpp_error("can't find "+source)
+        if xmlpp_DEBUG:
+            xmlpp_debug_file = open('debug-pp.txt', 'w')
+            print(xmlpp_VERSION, file=xmlpp_debug_file)
+        try:
+            xmlpp_result = xmlpp_process(source)
+            if dest is not None: xmlpp_write_dest(dest)
+            elif xmlpp_DEBUG: print(f"\nFinished: no preprocessor errors found.", file=xmlpp_debug_file)
+        finally:
+            if xmlpp_DEBUG: xmlpp_debug_file.close()
+            self.dependencies = list(xmlpp_dependencies)
+        return xmlpp_result
+
+PreprocessorError = xmlpp_error
+
+def xmlpp_watch():
+    # Calls xmlpp_run() whenever a file it depends on changes. Runs until interrupted.
+    XMLPP_POLL_SECONDS = 0.5    # interval between checks for changes
+    XMLPP_SETTLE_SECONDS = 0.2  # how long files must be unchanged before processing (debounce)
+    import traceback
+
+    def xmlpp_file_states(xmlpp_paths):
+        xmlpp_states = {}
+        for xmlpp_path in xmlpp_paths:
+            try:
+                xmlpp_stat = os.stat(xmlpp_path)
+                xmlpp_states[xmlpp_path] = (xmlpp_stat.st_mtime_ns, xmlpp_stat.st_size)
+            except OSError:
+                xmlpp_states[xmlpp_path] = None
+        return xmlpp_states
+
+    xmlpp_watched = {os.path.abspath(xmlpp_source_file)}
+    try:
+        while True:
+            xmlpp_start = time.perf_counter()
+            try:
+                if xmlpp_run(): print(f"✅ Processed {xmlpp_source_file} in {time.perf_counter() - xmlpp_start:.3f} s")
+            except xmlpp_error as e:
+                e.report()
+            except Exception:
+                traceback.print_exc()
+            # Keep watching files from earlier runs too, in case this run failed before loading them:
+            xmlpp_watched.update(xmlpp_dependencies)
+            xmlpp_states = xmlpp_file_states(xmlpp_watched)
+            print(f"Watching {len(xmlpp_watched)} file(s) for changes; press Ctrl+C to stop...")
+            while True:
+                time.sleep(XMLPP_POLL_SECONDS)
+                xmlpp_new_states = xmlpp_file_states(xmlpp_watched)
+                if xmlpp_new_states != xmlpp_states: break
+            while True:     # wait for changes to settle, in case an editor writes files in several steps
+                time.sleep(XMLPP_SETTLE_SECONDS)
+                xmlpp_states, xmlpp_new_states = xmlpp_new_states, xmlpp_file_states(xmlpp_watched)
+                if xmlpp_new_states == xmlpp_states: break
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+def xmlpp_load_jobs(xmlpp_jobs_file):
+    # Returns list of (source, dest, variables) from the JSON list of jobs in xmlpp_jobs_file.
+    # Paths are relative to xmlpp_jobs_file. Variables are used as JSON decoded them (not evaluated as Python).
+    try:
+        with open(xmlpp_jobs_file, 'r') as xmlpp_file:
+            xmlpp_entries = json.load(xmlpp_file)
+    except Exception as e:
+        raise xmlpp_error(f"{type(e).__name__} in \"{xmlpp_jobs_file}\": {sys.exception()}")
+    if not isinstance(xmlpp_entries, list): raise xmlpp_error(f"\"{xmlpp_jobs_file}\" should contain a list of jobs.")
+
+    xmlpp_dir = os.path.dirname(xmlpp_jobs_file)
+    xmlpp_jobs = []
+    for xmlpp_number, xmlpp_entry in enumerate(xmlpp_entries, start=1):
+        if not isinstance(xmlpp_entry, dict) or "source" not in xmlpp_entry or "dest" not in xmlpp_entry:
+            raise xmlpp_error(f"Job {xmlpp_number} in \"{xmlpp_jobs_file}\" is missing 'source' or 'dest'.")
+        xmlpp_job_variables = xmlpp_entry.get("variables", {})
+        if not isinstance(xmlpp_job_variables, dict):
+            raise xmlpp_error(f"'variables' of job {xmlpp_number} in \"{xmlpp_jobs_file}\" should be an object.")
+        xmlpp_jobs.append((os.path.join(xmlpp_dir, xmlpp_entry["source"]), os.path.join(xmlpp_dir, xmlpp_entry["dest"]), xmlpp_job_variables))
+    return xmlpp_jobs
+
+def xmlpp_init_worker(xmlpp_options):
+    # Sets options in a batch worker process (which, depending on platform, may not have run xmlpp_parse_args()).
+    global xmlpp_PHASED, xmlpp_INCREMENTAL, xmlpp_STREAM, xmlpp_LOW_MEMORY, xmlpp_PRETTY, xmlpp_STRICT, xmlpp_OVERWRITE
+    xmlpp_PHASED, xmlpp_INCREMENTAL, xmlpp_STREAM, xmlpp_LOW_MEMORY, xmlpp_PRETTY, xmlpp_STRICT = xmlpp_options
+    xmlpp_OVERWRITE = True
+
+def xmlpp_run_job(xmlpp_job):
+    # Runs one batch job. Returns (result, seconds, console output), where result is True if dest was written,
+    # False if it was up to date, or None if there was an error.
+    global xmlpp_source_file, xmlpp_dest_file, xmlpp_variables
+    xmlpp_source_file, xmlpp_dest_file, xmlpp_variables = xmlpp_job
+    import contextlib
+    import traceback
+    xmlpp_start = time.perf_counter()
+    xmlpp_output = io.StringIO()
+    with contextlib.redirect_stdout(xmlpp_output):
+        try:
+            if not os.path.exists(xmlpp_source_file): raise xmlpp_error("can't find "+xmlpp_source_file)
+            xmlpp_result = xmlpp_run()
+        except xmlpp_error as e:
+            e.report()
+            xmlpp_result = None
+        except Exception:
+            traceback.print_exc(file=xmlpp_output)
+            xmlpp_result = None
+    return xmlpp_result, time.perf_counter() - xmlpp_start, xmlpp_output.getvalue()
+
+def xmlpp_batch():
+    # Runs every job in xmlpp_source_file, spread over several processes. Returns number of jobs that failed.
+    xmlpp_start = time.perf_counter()
+    xmlpp_jobs = xmlpp_load_jobs(xmlpp_source_file)
+
+    if not xmlpp_OVERWRITE:
+        xmlpp_existing = sum(1 for xmlpp_job in xmlpp_jobs if os.path.exists(xmlpp_job[1]))
+        if xmlpp_existing:
+            xmlpp_overwrite_input = input(f"{xmlpp_existing} destination file(s) already exist; overwrite them (y/n)? ")
+            if (xmlpp_overwrite_input != "y"): exit(2)
+
+    # Worker processes each keep their own xmlpp_parse_cache, so an imported file is parsed at most once per worker.
+    # Jobs writing the same dest aren't detected; the last one to finish wins.
+    xmlpp_options = (xmlpp_PHASED, xmlpp_INCREMENTAL, xmlpp_STREAM, xmlpp_LOW_MEMORY, xmlpp_PRETTY, xmlpp_STRICT)
+    xmlpp_workers = min(xmlpp_JOBS or os.cpu_count() or 1, len(xmlpp_jobs)) or 1
+    if xmlpp_workers == 1:
+        xmlpp_init_worker(xmlpp_options)
+        xmlpp_results = map(xmlpp_run_job, xmlpp_jobs)
+        xmlpp_executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        xmlpp_executor = ProcessPoolExecutor(xmlpp_workers, initializer=xmlpp_init_worker, initargs=(xmlpp_options,))
+        xmlpp_results = xmlpp_executor.map(xmlpp_run_job, xmlpp_jobs)
+
+    xmlpp_counts = {True: 0, False: 0, None: 0}
+    xmlpp_job_seconds = 0
+    for xmlpp_job, (xmlpp_result, xmlpp_seconds, xmlpp_output) in zip(xmlpp_jobs, xmlpp_results):
+        xmlpp_counts[xmlpp_result] += 1
+        xmlpp_job_seconds += xmlpp_seconds
+        if xmlpp_result is None:
+            print(f"❌ {xmlpp_job[0]} → {xmlpp_job[1]} ({xmlpp_seconds:.3f} s)")
+            print(''.join(f"   {xmlpp_line}\n" for xmlpp_line in xmlpp_output.splitlines() if not xmlpp_line.startswith("Phase ") and xmlpp_line), end='')
+        else:
+            print(f"{'✅' if xmlpp_result else '➖'} {xmlpp_job[0]} → {xmlpp_job[1]} ({'up to date' if not xmlpp_result else f'{xmlpp_seconds:.3f} s'})")
+    if xmlpp_executor is not None: xmlpp_executor.shutdown()
+
+    print(f"\n{len(xmlpp_jobs)} job(s) in {time.perf_counter() - xmlpp_start:.3f} s using {xmlpp_workers} process(es): "
+          f"{xmlpp_counts[True]} written, {xmlpp_counts[False]} up to date, {xmlpp_counts[None]} failed "
+          f"(total processing time {xmlpp_job_seconds:.3f} s)")
+    return xmlpp_counts[None]
+
+def xmlpp_report_timing(xmlpp_ready_seconds):   # --timing
+    # Prints how long starting up took, compared with processing. xmlpp_ready_seconds is when this file finished
+    # defining everything (ie, when it was ready to start processing), from time.perf_counter().
+    xmlpp_end_seconds = time.perf_counter()
+    xmlpp_startup_seconds = xmlpp_ready_seconds - xmlpp_start_seconds[0]
+    xmlpp_processing_seconds = xmlpp_end_seconds - xmlpp_ready_seconds - xmlpp_lxml_seconds
+    print("\nTiming (elapsed time since preprocess.py started running):")
+    print(f"   {'Importing modules and defining functions':<56} {xmlpp_startup_seconds:8.3f} s")
+    print(f"   {'Importing lxml' if xmlpp_ET is not None else 'Importing lxml (not imported)':<56} {xmlpp_lxml_seconds:8.3f} s")
+    print(f"   {'Processing':<56} {xmlpp_processing_seconds:8.3f} s")
+    print(f"   {'Total':<56} {xmlpp_end_seconds - xmlpp_start_seconds[0]:8.3f} s")
+    # Elapsed time before this file started running can't be measured portably, but CPU time can:
+    print(f"   Before that, starting Python and compiling preprocess.py used {xmlpp_start_seconds[1]:.3f} s of CPU time.")
+
+if __name__ == "__main__":  # not when imported by a batch worker process
+    xmlpp_ready_seconds = time.perf_counter()
+    try:
+        xmlpp_parse_args()
+        if xmlpp_BATCH:
+            if xmlpp_batch(): exit(1)
+        elif xmlpp_WATCH:
+            xmlpp_watch()
+        else:
+            xmlpp_run()
+        if xmlpp_TIMING: xmlpp_report_timing(xmlpp_ready_seconds)
+    except xmlpp_error as e:
+        e.report()
+        exit(1)